@@ -61,12 +61,16 @@ For detailed documentation on these methods see:
         - L{pyperry.base.Base.has_one}
         - L{pyperry.base.Base.belongs_to}
     - L{pyperry.base.Base.scope}
+    - Identity map:  L{pyperry.identity_map}
+    - Preloading loaded records:  L{pyperry.preload}
 
 """
 
 from pyperry.base import Base
 from pyperry.relation import Relation
 from pyperry.association import Association
+from pyperry.identity_map import identity_scope
+from pyperry.processors.preload_associations import preload
 import logging
 
 # Override this with a custom logger
@@ -36,6 +36,41 @@ only difference between a middleware and a processor is that the objects
 returned to a processor are always instantiated records whereas middlewares
 receive the raw response.
 
+Streaming reads
+---------------
+
+A read called with C{stream=True} (see L{pyperry.relation.Relation.stream})
+may return a generator instead of a list so records are produced one at a
+time.  An adapter whose C{read} can do this sets C{features['streaming']} to
+True, and each processor and middleware class declares that it can pass a
+stream through by setting C{features = { 'streaming': True }}.  Stack items
+that need the whole result, like a cache, leave it unset.  If the adapter or
+any stack item can't stream, the read is made without C{stream} and returns
+the usual list.
+
+Raw reads
+---------
+
+A read called with C{raw=True} (see L{pyperry.relation.Relation.pluck}) is
+not instantiated by the ModelBridge, so processors receive the raw records
+too.  Processors that need model instances should leave raw reads alone.
+
+Counting
+--------
+
+Adapters that can count the records matching a relation without returning
+them set C{features['count']} to True and implement a C{count} method, which
+is called through the stack with C{mode='count'} and returns an integer (see
+L{pyperry.relation.Relation.count}).
+
+Keyset paging
+-------------
+
+Adapters whose C{read} understands SQL string conditions comparing the
+primary key, like C{'id > 1000'}, set C{features['keyset']} to True so that
+L{pyperry.relation.Relation.find_in_batches} pages on the primary key.  Other
+adapters are paged with C{limit} and C{offset}.
+
 """
 from copy import copy
 import socket
@@ -117,7 +152,10 @@ class AbstractAdapter(object):
         #
         # Specifies optional features that are implemented by this adapter
         self.features = {
-                'batch_write': False }
+                'batch_write': False,
+                'streaming': False,
+                'count': False,
+                'keyset': False }
 
         if 'timeout' in self.config.keys():
             socket.setdefaulttimeout(self.config['timeout'])
@@ -153,6 +191,24 @@ class AbstractAdapter(object):
 
         return self._stack
 
+    @property
+    def streamable(self):
+        """
+        True if this adapter and every item in its stack can handle a streamed
+        read
+
+        """
+        if not self.features['streaming']:
+            return False
+
+        for item in self.processors + [ModelBridge] + self.middlewares:
+            if isinstance(item, (list, tuple)):
+                item = item[0]
+            if not getattr(item, 'features', {}).get('streaming'):
+                return False
+
+        return True
+
     def reset(self):
         """Clear out the stack causing it to be rebuilt on the next request"""
         self._stack = None
@@ -168,6 +224,8 @@ class AbstractAdapter(object):
         if 'mode' not in kwargs:
             raise errors.ConfigurationError("Must pass `mode` to adapter call")
         pyperry.logger.debug('%s: %s' % (kwargs['mode'], kwargs.keys()))
+        if kwargs.get('stream') and not self.streamable:
+            kwargs['stream'] = False
         result = self.stack(**kwargs)
 
         if kwargs['mode'] is 'read' and not hasattr(result, '__iter__'):
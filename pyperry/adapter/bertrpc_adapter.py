@@ -12,12 +12,17 @@ class BERTRPC(AbstractAdapter):
         - namespace: the module that the call lives in (required)
         - procedure: the remote procedure to call (required)
         - base_options: options that will be included with every request
+        - count_procedure: the remote procedure to call for counts.  It is
+          given the same options as a read and must return the number of
+          matching records.  Relations are counted by reading every record
+          if this is not configured.
 
     """
 
     def __init__(self, *args, **kwargs):
         super(BERTRPC, self).__init__(*args, **kwargs)
         self.features['batch_write'] = True
+        self.features['count'] = 'count_procedure' in self.config.keys()
 
     def read(self, **kwargs):
         options = kwargs['relation'].query()
@@ -28,6 +33,16 @@ class BERTRPC(AbstractAdapter):
 
         return self._call_server(options)
 
+    def count(self, **kwargs):
+        options = kwargs['relation'].query()
+        options.update(self.config['base_options'])
+        options['mode'] = 'count'
+        procedure = self.config['count_procedure']
+
+        pyperry.logger.info('RPC.%s: %s' % (procedure, options))
+
+        return int(self._call_server(options, procedure))
+
     def write(self, **kwargs):
         model = kwargs.get('model')
         options = self.config['base_options'].copy()
@@ -60,10 +75,10 @@ class BERTRPC(AbstractAdapter):
         return self._parse_response(self._call_server(options))
 
 
-    def _call_server(self, options):
+    def _call_server(self, options, procedure=None):
         request = self.service.request('call')
         module = getattr(request, self.config['namespace'])
-        procedure = getattr(module, self.config['procedure'])
+        procedure = getattr(module, procedure or self.config['procedure'])
         return procedure(options)
 
     def _parse_response(self, raw):
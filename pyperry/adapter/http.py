@@ -54,8 +54,17 @@ class RestfulHttpAdapter(AbstractAdapter):
           sending over HTTP. The default serializer serializes C{None} as
           C{''}, C{True} as C{'true'} and C{False} as C{'false'}.
 
+        - B{count_service}: the name of a service that returns the number of
+          records matching the query string it is given, either as a number
+          or as a dict with a C{count} key.  If this is not configured,
+          relations are counted by reading every record.
+
     """
 
+    def __init__(self, *args, **kwargs):
+        super(RestfulHttpAdapter, self).__init__(*args, **kwargs)
+        self.features['count'] = 'count_service' in self.config.keys()
+
     def read(self, **kwargs):
         """
         Performs an HTTP GET request and uses the relation dict to construct
@@ -77,6 +86,29 @@ class RestfulHttpAdapter(AbstractAdapter):
             raise MalformedResponse('parsed response is not a list')
         return records
 
+    def count(self, **kwargs):
+        """
+        Performs an HTTP GET request to the C{count_service} with the same
+        query string as a read and returns the count from the response
+
+        """
+        relation = kwargs['relation']
+        url = '/%s.%s' % (self.config_value('count_service'),
+                self.config_value('format', 'json'))
+
+        query_string = self.query_string_for(relation)
+        if query_string is not None:
+            url += query_string
+
+        http_response, body = self.http_request('GET', url, {}, **kwargs)
+        count = self.response(http_response, body).parsed()
+        if isinstance(count, dict):
+            count = count.get('count')
+        try:
+            return int(count)
+        except (TypeError, ValueError):
+            raise MalformedResponse('parsed response is not a count')
+
     def write(self, **kwargs):
         model = kwargs['model']
         if model.new_record:
@@ -1,6 +1,7 @@
 import re
 import pyperry.base
 from pyperry import errors
+from pyperry import auto_preload
 from pyperry.relation import Relation
 
 class Association(object):
@@ -95,6 +96,9 @@ class Association(object):
             return self
         elif hasattr(instance, self.cache_id):
             return getattr(instance, self.cache_id)
+        elif (auto_preload.load(self, instance) and
+              hasattr(instance, self.cache_id)):
+            return getattr(instance, self.cache_id)
         else:
             val = self.scope(instance)
             if not self.collection() and val is not None:
@@ -147,10 +151,16 @@ class Association(object):
     foreign_key = property(get_foreign_key, set_foreign_key)
 
     def eager_loadable(self):
+        if self.dynamic_options():
+            return False
+        return not (self.type() == 'belongs_to' and self.polymorphic())
+
+    def dynamic_options(self):
+        """True if any finder option is a function of the target record"""
         for option in self.finder_options():
             if type(self.options.get(option)).__name__ == 'function':
-                return False
-        return not (self.type() == 'belongs_to' and self.polymorphic())
+                return True
+        return False
 
     # MBM: This needs to be moved somewhere else. Probably in a constant.
     def finder_options(self):
@@ -287,7 +297,14 @@ class BelongsTo(Association):
         if isinstance(obj_or_list, pyperry.Base):
             keys = obj_or_list[self.foreign_key]
         else:
-            keys = [o[self.foreign_key] for o in obj_or_list]
+            # Many records may belong to the same record
+            keys = []
+            seen = set()
+            for o in obj_or_list:
+                key = o[self.foreign_key]
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(key)
 
         if keys is not None:
             return self._base_scope(obj_or_list).where({
@@ -349,7 +366,14 @@ class Has(Association):
             keys = obj_or_list[pk_attr]
             obj = obj_or_list
         else:
-            keys = [o[pk_attr] for o in obj_or_list]
+            # Records merged from several reads may repeat
+            keys = []
+            seen = set()
+            for o in obj_or_list:
+                key = o[pk_attr]
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(key)
             obj = obj_or_list[0]
 
         if keys is not None:
@@ -0,0 +1,133 @@
+"""
+Automatic preloading and N+1 detection
+
+Records read together remember the other records of their read, their
+I{siblings}, when their model sets C{auto_preload} or the N+1 detector is
+enabled::
+
+    class Article(pyperry.Base):
+        id = Field()
+        author_id = Field()
+        author = BelongsTo(class_name='Person')
+        auto_preload = True
+
+With C{auto_preload}, the first lazy load of an association on any record
+loads it for every sibling that has not loaded it yet, as if the read had
+included the association::
+
+    for article in Article.all():
+        print article.author.name    # one query for all of the authors
+
+Associations that can't be eager loaded are still loaded one record at a
+time.
+
+The N+1 detector counts the lazy association loads made on the siblings of a
+read.  Once more than C{threshold} siblings of one read have lazily loaded
+the same association, a warning is logged, or L{errors.NPlusOneQuery} is
+raised if C{raise_error} is set::
+
+    pyperry.auto_preload.detect(threshold=5, raise_error=True)
+
+Loads avoided by C{auto_preload} are not counted.
+
+"""
+import threading
+import weakref
+
+import pyperry
+from pyperry import errors
+
+# N+1 detector settings, see detect()
+detector = { 'threshold': None, 'raise_error': False }
+
+def detect(threshold=5, raise_error=False):
+    """
+    Enables the N+1 detector, or disables it if C{threshold} is None.
+
+    """
+    detector['threshold'] = threshold
+    detector['raise_error'] = raise_error
+
+def enabled(klass):
+    return bool(getattr(klass, 'auto_preload', False)) or (
+            detector['threshold'] is not None)
+
+
+class Siblings(object):
+    """The records read together, held by weak reference"""
+
+    def __init__(self, records):
+        self.records = [weakref.ref(record) for record in records]
+        self.lazy_loads = {}
+        self.reported = set()
+        # Ids of associations that failed to preload
+        self.unsupported = set()
+        self.lock = threading.Lock()
+
+    def live(self):
+        """Returns the sibling records that still exist"""
+        return [record for record in (ref() for ref in self.records)
+                if record is not None]
+
+    def lazy_load(self, association):
+        """
+        Counts a lazy load of association and reports it if the count is
+        over the detector's threshold.
+
+        """
+        threshold = detector['threshold']
+        if threshold is None:
+            return
+
+        with self.lock:
+            count = self.lazy_loads.get(association.id, 0) + 1
+            self.lazy_loads[association.id] = count
+            if count <= threshold or association.id in self.reported:
+                return
+            self.reported.add(association.id)
+
+        message = ('N+1 QUERY: %s.%s was loaded separately for %d records '
+                   'read together' % (association.target_klass.__name__,
+                                      association.id, count))
+        if detector['raise_error']:
+            raise errors.NPlusOneQuery(message)
+        pyperry.logger.warn(message)
+
+
+def attach(klass, records):
+    """Makes the records of one read siblings of each other"""
+    if len(records) < 2 or not enabled(klass):
+        return
+
+    siblings = Siblings(records)
+    for record in records:
+        record._siblings = siblings
+
+def load(association, instance):
+    """
+    Loads association for instance and its siblings in one batch if the
+    instance's model sets C{auto_preload}.  Returns True if the association
+    was loaded, or False if it must be loaded for instance alone, in which
+    case the lazy load is counted by the N+1 detector.
+
+    """
+    siblings = getattr(instance, '_siblings', None)
+    if siblings is None:
+        return False
+
+    if (getattr(instance.__class__, 'auto_preload', False) and
+            not association.dynamic_options() and
+            association.id not in siblings.unsupported):
+        records = [record for record in siblings.live()
+                   if not hasattr(record, association.cache_id)]
+        if len(records) > 1:
+            # Imported here because the processor imports the associations
+            from pyperry.processors.preload_associations import preload
+            try:
+                preload(records, association.id)
+                return True
+            except errors.AssociationPreloadNotSupported:
+                siblings.unsupported.add(association.id)
+
+    siblings.lazy_load(association)
+    return False
@@ -7,6 +7,7 @@ from pyperry import errors
 from pyperry import callbacks
 from pyperry.relation import Relation
 from pyperry.adapter.abstract_adapter import AbstractAdapter
+from pyperry import record_cache
 from pyperry.association import BelongsTo, HasMany, HasOne, Association
 from pyperry.field import Field
 from pyperry.scope import Scope, DefaultScope
@@ -44,8 +45,9 @@ class BaseMeta(type):
 
     _relation_delegates = (Relation.singular_query_methods +
                 Relation.plural_query_methods +
-                ['modifiers', 'all', 'first', 'find', 'update_all',
-                'delete_all'])
+                ['modifiers', 'all', 'first', 'find', 'find_each',
+                'find_in_batches', 'stream', 'count', 'exists', 'pluck',
+                'values', 'update_all', 'delete_all'])
 
     def __init__(cls, name, bases, class_dict):
         """Class has been created now setup additional needs"""
@@ -805,6 +807,9 @@ class Base(object):
         """
         Execute query using relation on the read adapter stack
 
+        Primary key lookups are answered from the L{record cache
+        <pyperry.record_cache>} when it is enabled for the model.
+
         @param relation: An instance of C{Relation} describing the query
         @return: list of records from adapter query data each with new_record
         set to false.  C{None} items are removed.
@@ -816,8 +821,37 @@ class Base(object):
                     "pyperry.adapters.AbstractAdapter in order to call "
                     "fetch_records()")
 
+        records = record_cache.fetch(relation)
+        if records is not None:
+            return records
+
         return cls.reader(relation=relation, mode='read')
 
+    @classmethod
+    def stream_records(cls, relation):
+        """
+        Execute query using relation on the read adapter stack as a L{streamed
+        read <pyperry.adapter.abstract_adapter>}, yielding records as the
+        adapter produces them.  Adapter stacks that can't stream are read in
+        full first.
+
+        @param relation: An instance of C{Relation} describing the query
+        @return: generator of records with new_record set to false
+
+        """
+        if not hasattr(cls, 'reader'):
+            raise errors.ConfigurationError(
+                    "You must set `reader` attribute to an instance of "
+                    "pyperry.adapters.AbstractAdapter in order to call "
+                    "stream_records()")
+
+        records = record_cache.fetch(relation)
+        if records is None:
+            records = cls.reader(relation=relation, mode='read', stream=True)
+
+        for record in records:
+            yield record
+
     #{ Scoping
     @classmethod
     def relation(cls):
@@ -1,13 +1,34 @@
 
 enabled = True
 registry = []
+invalidators = {}
 
 def reset():
     for item in registry:
         item()
 
-def register(function):
+def register(function, invalidator=None):
+    """
+    Register C{function} to be called on L{reset}.  If C{invalidator} is given
+    it is called with the model classes passed to L{invalidate} instead of
+    resetting everything.
+
+    """
     registry.append(function)
+    if invalidator is not None:
+        invalidators[function] = invalidator
+
+def invalidate(*klasses):
+    """
+    Expire cached data for the given model classes only.  Registered items
+    without an invalidator fall back to a full reset.
+
+    """
+    for item in registry:
+        if item in invalidators:
+            invalidators[item](*klasses)
+        else:
+            item()
 
 def enable():
     enabled = True
@@ -18,4 +39,3 @@ def disable():
 def clean_registry():
     registry = []
     enabled = True
-
@@ -31,3 +31,6 @@ class AssociationPreloadNotSupported(PerryError):
 class RecordNotFound(PerryError):
     pass
 
+class NPlusOneQuery(PerryError):
+    pass
+
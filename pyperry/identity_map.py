@@ -0,0 +1,89 @@
+"""
+Identity map support
+
+Within an L{identity_scope} the L{ModelBridge} builds at most one instance
+for each model class and primary key.  Any later read of the same record
+during the scope returns the instance that was already built, so object
+identity stays consistent across association traversals and the cost of
+instantiating the same record again is avoided::
+
+    with pyperry.identity_scope():
+        article = Article.first()
+        assert article.author is Person.find(article.author_id)
+
+Records read with a C{select} only hold some of their fields, so they are
+always built as new instances and never stored in the map.
+
+Instances are held by weak reference, so the map never keeps a model alive
+longer than the rest of the program does.  Scopes are local to the current
+thread and nested scopes share the outermost map.  Threads that join a scope
+(see L{pyperry.parallel}) share its map, so the map is locked while it is
+read and updated.
+
+"""
+import threading
+import weakref
+from contextlib import contextmanager
+
+_state = threading.local()
+
+class IdentityMap(object):
+    """Weak mapping of (model class, primary key) to model instances"""
+
+    def __init__(self):
+        self.instances = weakref.WeakValueDictionary()
+        self.lock = threading.RLock()
+
+    def load(self, klass, record):
+        """
+        Returns the instance already built for the record's primary key or
+        builds, stores and returns a new stored instance of C{klass}.
+
+        """
+        pk = record.get(klass.primary_key())
+        if pk is None:
+            return klass(record, False)
+
+        with self.lock:
+            instance = self.instances.get((klass, pk))
+            if instance is None:
+                instance = klass(record, False)
+                self.instances[(klass, pk)] = instance
+            return instance
+
+    def get(self, klass, pk):
+        return self.instances.get((klass, pk))
+
+    def discard(self, instance):
+        """Removes instance from the map if it is present"""
+        key = (instance.__class__, instance.pk_value())
+        with self.lock:
+            if self.instances.get(key) is instance:
+                del self.instances[key]
+
+    def __len__(self):
+        return len(self.instances)
+
+def current():
+    """Returns the L{IdentityMap} of the active scope or None"""
+    stack = getattr(_state, 'stack', None)
+    if stack:
+        return stack[-1]
+
+@contextmanager
+def identity_scope(identities=None):
+    """
+    Context manager activating an L{IdentityMap} for the current thread.  The
+    given map is used if there is one, which lets other threads join a scope.
+    """
+    if not hasattr(_state, 'stack'):
+        _state.stack = []
+    if identities is None:
+        identities = current()
+    if identities is None:
+        identities = IdentityMap()
+    _state.stack.append(identities)
+    try:
+        yield identities
+    finally:
+        _state.stack.pop()
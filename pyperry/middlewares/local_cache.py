@@ -1,40 +1,495 @@
 import pyperry
 from datetime import datetime, timedelta
-import hashlib
+from collections import OrderedDict
+import heapq
+import sys
+import threading
+import time
+import Queue
+import marshal
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 from pyperry.relation import Relation
 from pyperry import caching
+from pyperry import errors
+
+def synchronized(method):
+    """Run C{method} while holding the instance's C{lock}"""
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+# Version of the LocalCache snapshot file layout
+SNAPSHOT_FORMAT = 1
+
+class EvictionPolicy(object):
+    """
+    Base class for L{CacheStore} eviction policies.
+
+    The store always keeps its entries in least recently used order and asks
+    the policy whether a new entry should be admitted at the cost of evicting
+    the current least recently used entry.  The default implementation admits
+    everything, which results in plain LRU eviction.
+
+    """
+
+    def record(self, key):
+        """Called each time C{key} is read or written"""
+        pass
+
+    def admit(self, candidate, victim):
+        """Return True if C{candidate} may replace C{victim} in the store"""
+        return True
+
+    def clear(self):
+        """Forget any state collected by the policy"""
+        pass
+
+class LRUPolicy(EvictionPolicy):
+    """Evicts the least recently used entry to make room for new entries"""
+    pass
+
+class TinyLFUPolicy(EvictionPolicy):
+    """
+    TinyLFU admission policy
+
+    Access frequencies are estimated with a small count-min sketch.  A new
+    entry is only admitted when it has been requested more often than the
+    least recently used entry it would replace, so a one-off scan of many
+    distinct queries cannot flush the frequently used entries.  All counters
+    are halved every C{sample_size} accesses so old popularity fades.
+
+    """
+
+    def __init__(self, width=1024, depth=4, sample_size=None):
+        self.width = width
+        self.depth = depth
+        self.sample_size = sample_size or width * 10
+        self.clear()
+
+    def record(self, key):
+        for row, index in self._indexes(key):
+            self.table[row][index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self._age()
+
+    def admit(self, candidate, victim):
+        return self.frequency(candidate) > self.frequency(victim)
+
+    def frequency(self, key):
+        return min(self.table[row][index]
+                   for row, index in self._indexes(key))
+
+    def clear(self):
+        self.table = [[0] * self.width for i in range(self.depth)]
+        self.additions = 0
+
+    def _indexes(self, key):
+        for row in range(self.depth):
+            yield row, hash((row, key)) % self.width
+
+    def _age(self):
+        for row in self.table:
+            for i in range(len(row)):
+                row[i] >>= 1
+        self.additions /= 2
 
 class CacheStore(object):
+    """
+    In memory key/value store with expiring entries
+
+    The store may be bounded by the number of entries (C{max_entries}) and by
+    the approximate number of bytes held (C{max_bytes}).  When either limit
+    is reached the least recently used entries are evicted subject to the
+    admission rules of the configured L{EvictionPolicy} (L{LRUPolicy} by
+    default).  Expiry times are kept in a heap so expired entries are removed
+    without scanning the whole store on every write.
+
+    Entries may be written with a list of tags (the model classes a cached
+    result depends on) so that L{invalidate} can remove only the entries
+    affected by a change.
+
+    An entry written with C{stale_at} stays readable until C{expire_at} but
+    is reported by L{stale} once C{stale_at} has passed.  An entry may also
+    record the C{cost} in seconds it took to produce.
+
+    Callables appended to C{listeners} are called with the key and tags of
+    each entry evicted to make room.  Entry sizes are measured when
+    C{max_bytes} or C{measure_bytes} is set.
 
-    def __init__(self, interval):
+    All public methods hold the store's lock, so a store may be shared
+    between threads.
+
+    """
+
+    def __init__(self, interval, max_entries=None, max_bytes=None,
+            policy=None, measure_bytes=False):
         self.default_interval = timedelta(seconds=interval)
-        self.store = {}
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy or LRUPolicy()
+        self.measure_bytes = measure_bytes
+        self.evictions = 0
+        self.listeners = []
+        self.lock = threading.RLock()
+        self._reset()
 
+    @synchronized
+    def configure(self, max_entries=None, max_bytes=None, policy=None,
+            measure_bytes=False):
+        """Set the limits and eviction policy used by the store"""
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy or LRUPolicy()
+        self.measure_bytes = measure_bytes
+        self._enforce_limits()
+
+    @synchronized
     def read(self, key):
+        self.policy.record(key)
         if self.store.has_key(key):
-            if self.store[key][1] > datetime.now():
-                return self.store[key][0]
+            entry = self.store.pop(key)
+            if entry[1] > datetime.now():
+                decoded = isinstance(entry[0], SnapshotEntry)
+                if decoded:
+                    try:
+                        entry = (entry[0].load(), entry[1])
+                    except Exception, err:
+                        pyperry.logger.warn(
+                                'CACHE SNAPSHOT ENTRY UNREADABLE: %s' % err)
+                        self._forget(key)
+                        return None
+                # Reinsert to mark the entry as most recently used
+                self.store[key] = entry
+                if decoded:
+                    self._remeasure(key)
+                return entry[0]
             else:
-                del self.store[key]
+                self._forget(key)
+
+    @synchronized
+    def entries(self):
+        """
+        Returns a list of (key, value, expire_at, tags, stale_at, cost) tuples
+        for the entries that have not expired.
 
-    def write(self, key, val, expire_at=None):
+        """
+        now = datetime.now()
+        return [(key, val, expire_at, self.entry_tags.get(key, ()),
+                 self.stale_times.get(key), self.costs.get(key))
+                for key, (val, expire_at) in self.store.iteritems()
+                if expire_at > now]
+
+    @synchronized
+    def write(self, key, val, expire_at=None, tags=None, stale_at=None,
+            cost=None):
         self.clear()
-        self.store[key] = (val,
-                expire_at or (datetime.now() + self.default_interval))
+        if self.store.has_key(key):
+            self._remove(key)
+
+        self.policy.record(key)
+        measure = self.max_bytes is not None or self.measure_bytes
+        size = self.size_of(val) if measure else 0
+        if not self._make_room(key, size):
+            return
+
+        expire_at = expire_at or (datetime.now() + self.default_interval)
+        self.store[key] = (val, expire_at)
+        self.sizes[key] = size
+        self.bytes += size
+        heapq.heappush(self.expiry, (expire_at, key))
 
+        if tags:
+            self.entry_tags[key] = tags
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+        if stale_at:
+            self.stale_times[key] = stale_at
+        if cost is not None:
+            self.costs[key] = cost
+
+    @synchronized
+    def stale(self, key):
+        """Returns True if the entry for C{key} is past its stale_at time"""
+        stale_at = self.stale_times.get(key)
+        return stale_at is not None and stale_at <= datetime.now()
+
+    @synchronized
     def clear(self, key=None):
         if key:
-            del self.store[key]
+            self._remove(key)
         else:
             now = datetime.now()
-            for key in self.store.keys():
-                if self.store[key][1] < now:
-                    del self.store[key]
+            while self.expiry and self.expiry[0][0] < now:
+                expire_at, key = heapq.heappop(self.expiry)
+                entry = self.store.get(key)
+                if entry is not None and entry[1] == expire_at:
+                    self._remove(key)
+            self._compact_expiry()
+
+    @synchronized
+    def invalidate(self, *tags):
+        """Remove all entries written with any of the given tags"""
+        for tag in tags:
+            for key in list(self.tags.get(tag, ())):
+                if self.store.has_key(key):
+                    self._remove(key)
 
+    @synchronized
     def empty(self):
         del self.store
-        self.store = {}
+        self._reset()
+        self.policy.clear()
+
+    def size_of(self, val, depth=3):
+        """Approximate the memory used by C{val} in bytes"""
+        size = sys.getsizeof(val)
+        if depth <= 0:
+            return size
+
+        if isinstance(val, dict):
+            for k, v in val.iteritems():
+                size += self.size_of(k, depth - 1) + self.size_of(v, depth - 1)
+        elif isinstance(val, (list, tuple, set)):
+            for item in val:
+                size += self.size_of(item, depth - 1)
+        elif hasattr(val, 'fields'):
+            size += self.size_of(val.fields, depth - 1)
+
+        return size
+
+    def _reset(self):
+        self.store = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.expiry = []
+        self.tags = {}
+        self.entry_tags = {}
+        self.stale_times = {}
+        self.costs = {}
+
+    def _make_room(self, key, size):
+        """
+        Evict entries until an entry of C{size} fits.  Returns False if the
+        entry should not be stored.
+
+        """
+        if self.max_bytes is not None and size > self.max_bytes:
+            return False
+
+        while self._over_limit(1, size):
+            victim = iter(self.store).next()
+            if not self.policy.admit(key, victim):
+                return False
+            self._evict(victim)
+
+        return True
+
+    def _remeasure(self, key):
+        """
+        Measure an entry again once its value has been decoded from a
+        snapshot, since it was stored with the size of its pickled data.
+
+        """
+        if self.max_bytes is None and not self.measure_bytes:
+            return
+        size = self.size_of(self.store[key][0])
+        self.bytes += size - self.sizes.get(key, 0)
+        self.sizes[key] = size
+        self._enforce_limits()
+
+    def _enforce_limits(self):
+        while self.store and self._over_limit(0, 0):
+            self._evict(iter(self.store).next())
+
+    def _evict(self, key):
+        tags = self.entry_tags.get(key, ())
+        self._remove(key)
+        self.evictions += 1
+        for listener in self.listeners:
+            listener(key, tags)
+
+    def _over_limit(self, entries, size):
+        return ((self.max_entries is not None and
+                    len(self.store) + entries > self.max_entries) or
+                (self.max_bytes is not None and
+                    self.bytes + size > self.max_bytes))
+
+    def _remove(self, key):
+        del self.store[key]
+        self._forget(key)
+
+    def _forget(self, key):
+        self.bytes -= self.sizes.pop(key, 0)
+        self.stale_times.pop(key, None)
+        self.costs.pop(key, None)
+        for tag in self.entry_tags.pop(key, ()):
+            keys = self.tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self.tags[tag]
+
+    def _compact_expiry(self):
+        """Drop heap items for keys that were removed or rewritten"""
+        if len(self.expiry) > 2 * len(self.store) + 64:
+            self.expiry = [(entry[1], key)
+                           for key, entry in self.store.iteritems()]
+            heapq.heapify(self.expiry)
+
+
+class SnapshotEntry(object):
+    """
+    A cached value left pickled in a memory mapped snapshot file until it is
+    first read from the L{CacheStore}.
+
+    """
+
+    def __init__(self, data, offset, length):
+        self.data = data
+        self.offset = offset
+        self.length = length
+
+    def raw(self):
+        return self.data[self.offset:self.offset + self.length]
+
+    def load(self):
+        return pickle.loads(self.raw())
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + self.length
+
+
+class Flight(object):
+    """A fetch in progress that other threads may wait on"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class CompactResult(object):
+    """
+    A cached result encoded with marshal or pickle, compressed with zlib when
+    the encoded result is larger than C{compress_threshold} bytes.  Model
+    instances are stored as their raw fields and rebuilt when decoded, so
+    every read gets its own copy of the records.
+
+    """
+
+    def __init__(self, result, codec='marshal', compress_threshold=None):
+        self.models = bool(result) and hasattr(result[0], 'fields')
+        records = result
+        if self.models:
+            records = [record.fields for record in result]
+
+        self.codec = codec
+        if codec == 'marshal':
+            try:
+                data = marshal.dumps(records)
+            except ValueError:
+                # Fall back to pickle for values marshal can't encode
+                self.codec = 'pickle'
+        if self.codec == 'pickle':
+            data = pickle.dumps(records, pickle.HIGHEST_PROTOCOL)
+
+        self.compressed = (compress_threshold is not None and
+                len(data) > compress_threshold)
+        self.data = zlib.compress(data) if self.compressed else data
+
+    def decode(self, klass=None):
+        """Returns the result, rebuilding model instances with C{klass}"""
+        data = zlib.decompress(self.data) if self.compressed else self.data
+        if self.codec == 'marshal':
+            records = marshal.loads(data)
+        else:
+            records = pickle.loads(data)
+
+        if self.models:
+            records = [klass(fields, False) for fields in records]
+        return records
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self.data)
+
+
+class Refresher(object):
+    """
+    Runs cache refreshes on background worker threads.  At most C{size}
+    refreshes may be waiting at once; further requests are dropped until the
+    workers catch up.  One refresher is shared by every L{LocalCache}, so a
+    key is only refreshed once however many stacks serve it.
+
+    """
+
+    def __init__(self, size=100, workers=1):
+        self.queue = Queue.Queue(size)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def schedule(self, cache, key, kwargs):
+        """
+        Queue a refresh of C{key} through C{cache} returning False if it was
+        not queued
+
+        """
+        with self.lock:
+            if key in self.pending:
+                return False
+            try:
+                self.queue.put_nowait((cache, key, kwargs))
+            except Queue.Full:
+                return False
+            self.pending.add(key)
+            return True
+
+    def stop(self):
+        """Ends the worker threads once the queued refreshes have run"""
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            cache, key, kwargs = item
+            try:
+                cache.refresh(key, **kwargs)
+            except Exception, err:
+                pyperry.logger.error('CACHE REFRESH FAILED: %s' % err)
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+                self.queue.task_done()
 
 
 class LocalCache(object):
@@ -42,14 +497,39 @@ class LocalCache(object):
 
     Caches results of queries in memory returning the previous result of
     repeated queries until the entry expires.  Entries are cached based on
-    the query used.
+    the query used (see L{Relation.fingerprint}).
 
     Config options:
         - interval: The interval in seconds that a given cache entry will be
           considered fresh
+        - negative_interval: The interval in seconds that an empty result will
+          be cached.  Empty results are not cached unless this is set.  Hits
+          on empty entries are reported as C{negative_hits} by L{stats}.
         - max_entry_size: Max len of results that will be cached.  If set only
           results less than this value will be stored in the cache.  All others
           will be refetched every time.
+        - single_flight: If True, concurrent misses for the same query wait
+          for a single fetch through the rest of the stack and share its
+          result.  The number of fetches and of coalesced misses are
+          reported by L{stats}.
+        - stale_ttl: Number of seconds an expired entry is still served while
+          it is refreshed in the background through the rest of the stack.
+        - refresh_queue_size: Max number of background refreshes waiting to
+          run when stale_ttl is set (default 100).
+        - refresh_workers: Number of background refresh threads (default 1).
+          The refresh threads are shared by all LocalCache instances and
+          are started with the options of the first one to refresh an
+          entry; L{stop_refresher} stops them.
+        - serialize: Store results encoded with C{'marshal'} or C{'pickle'}
+          instead of the live objects (see L{CompactResult}).  This uses much
+          less memory at the cost of decoding the records on every hit.
+        - compress_threshold: When serializing, compress encoded results
+          larger than this many bytes with zlib.
+
+    Each entry is tagged with the model class of the query and any classes
+    reached through its includes.  Writes through the L{ModelBridge} call
+    L{caching.invalidate} with the written model's class, which only removes
+    the entries tagged with that class.
 
     Importing this module adds the fresh query option to Relation.  This allows
     the developer to easily force a query to be fresh::
@@ -57,10 +537,48 @@ class LocalCache(object):
         # This query will always fetch fresh data
         Person.where({ 'name': 'bob' }).fresh()
 
+    The shared L{CacheStore} is unbounded by default.  Limits and an eviction
+    policy can be set on it directly::
+
+        LocalCache.cache_store.configure(max_entries=10000,
+                max_bytes=64 * 1024 * 1024, policy=TinyLFUPolicy())
+
+    The live entries can be written to a snapshot file with L{save_snapshot},
+    for example on shutdown, and loaded by a new process with
+    L{load_snapshot} so it starts with a warm cache::
+
+        atexit.register(LocalCache.save_snapshot, path, version=DEPLOY_ID)
+        LocalCache.load_snapshot(path, version=DEPLOY_ID)
+
+    L{stats} reports hits, misses, evictions, entries, bytes held and the
+    adapter time saved by hits, overall and for each model class.  Callbacks
+    for the C{'hit'}, C{'miss'} and C{'evict'} events can be added with
+    L{subscribe}::
+
+        LocalCache.subscribe('miss', lambda relation, key: log(relation))
+
     """
     # Initialize store with default interval of 5 minutes
     cache_store = CacheStore(300)
 
+    # Background refreshes of stale entries, see schedule_refresh()
+    refresher = None
+    refresher_lock = threading.Lock()
+
+    # Fetches in progress by cache key when running in single_flight mode
+    flights = {}
+    flights_lock = threading.Lock()
+
+    # Statistics and event callbacks shared by all LocalCache instances
+    counters = { 'hits': 0, 'misses': 0, 'negative_hits': 0, 'evictions': 0,
+                 'time_saved': 0.0, 'fetches': 0, 'coalesced': 0,
+                 'refreshes': 0, 'refreshes_dropped': 0 }
+    model_counters = {}
+    stats_lock = threading.Lock()
+    listeners = { 'hit': [], 'miss': [], 'evict': [] }
+    # Results are cached as a whole
+    features = { 'streaming': False }
+
     def __init__(self, next, options=None):
         if not options:
             options = {}
@@ -68,34 +586,372 @@ class LocalCache(object):
         self.options = options
 
     def __call__(self, **kwargs):
+        # Raw reads share their fingerprint with instantiated reads
+        if kwargs['mode'] != 'read' or kwargs.get('raw'):
+            return self.next(**kwargs)
+
         rel = kwargs['relation']
-        key = hashlib.sha1("%s--%s" % (rel.klass, rel.query())).hexdigest()
+        key = rel.fingerprint()
 
         result = self.cache_store.read(key)
+        if isinstance(result, CompactResult):
+            result = result.decode(rel.klass)
 
-        if (not result or rel.params['fresh']) and caching.enabled:
+        if (result is None or rel.params['fresh']) and caching.enabled:
+            self.count([rel.klass], misses=1)
+            self.notify('miss', rel, key)
             # Call the next item in the stack to get a fresh result
-            result = self.next(**kwargs)
+            started = time.time()
+            result = self.fetch(key, **kwargs)
+            self.write(key, result, rel, time.time() - started)
         else:
             pyperry.logger.info('CACHE: %s' % kwargs['relation'].query())
+            self.count([rel.klass], hits=1,
+                    negative_hits=0 if result else 1,
+                    time_saved=self.cache_store.costs.get(key, 0.0))
+            self.notify('hit', rel, key)
+            if self.options.get('stale_ttl') and self.cache_store.stale(key):
+                self.schedule_refresh(key, kwargs)
+
+        return result
 
+    def write(self, key, result, relation, cost=None):
+        """
+        Stores a fetched result for relation under the given key.  C{cost} is
+        the number of seconds the fetch took.
+
+        """
+        # Only store records < configured max_entry_size if set
+        if (self.options.has_key('max_entry_size') and
+                self.options['max_entry_size'] <= len(result)):
+            return
+
+        if not result:
+            # Empty results are only cached with a negative_interval
+            if not self.options.has_key('negative_interval'):
+                return
+            interval = self.options['negative_interval']
+        else:
+            interval = self.options.get('interval')
 
         # Use configured cache expiry interval if set
         expires_at = None
-        if self.options.has_key('interval'):
-            expires_at = (datetime.now() +
-                timedelta(seconds=self.options.get('interval')))
+        if interval is not None:
+            expires_at = datetime.now() + timedelta(seconds=interval)
 
-        # Only store records < configured max_entry_size if set
-        if (not self.options.has_key('max_entry_size') or
-                self.options['max_entry_size'] > len(result)):
-            self.cache_store.write(key, result, expires_at)
+        stale_at = None
+        if self.options.get('stale_ttl'):
+            stale_at = expires_at or (datetime.now() +
+                    self.cache_store.default_interval)
+            expires_at = stale_at + timedelta(
+                    seconds=self.options['stale_ttl'])
 
-        return result
+        records = result
+        if self.options.get('serialize'):
+            codec = self.options['serialize']
+            result = CompactResult(result,
+                    codec if codec in ['marshal', 'pickle'] else 'marshal',
+                    self.options.get('compress_threshold'))
+
+        self.cache_store.write(key, result, expires_at,
+                self.tags_for(relation, records), stale_at, cost)
+
+    def schedule_refresh(self, key, kwargs):
+        """Queues a background refresh of a stale entry"""
+        with LocalCache.refresher_lock:
+            if LocalCache.refresher is None:
+                LocalCache.refresher = Refresher(
+                        self.options.get('refresh_queue_size', 100),
+                        self.options.get('refresh_workers', 1))
+            refresher = LocalCache.refresher
+
+        if refresher.schedule(self, key, kwargs):
+            self.counters['refreshes'] += 1
+        else:
+            self.counters['refreshes_dropped'] += 1
+
+    @classmethod
+    def stop_refresher(cls):
+        """
+        Stops the shared background refresh threads after the refreshes
+        already queued.  They are started again by the next stale hit.
+
+        """
+        with LocalCache.refresher_lock:
+            refresher = LocalCache.refresher
+            LocalCache.refresher = None
+        if refresher is not None:
+            refresher.stop()
+
+    def refresh(self, key, **kwargs):
+        """Refetches and stores the result for key (run by the Refresher)"""
+        started = time.time()
+        result = self.next(**kwargs)
+        self.write(key, result, kwargs['relation'], time.time() - started)
+
+    def fetch(self, key, **kwargs):
+        """
+        Calls the next item in the stack.  In single_flight mode only one
+        thread fetches a given key at a time; the others wait for its result.
+
+        """
+        if not self.options.get('single_flight'):
+            return self.next(**kwargs)
+
+        with self.flights_lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = Flight()
+                self.counters['fetches'] += 1
+                leader = True
+            else:
+                self.counters['coalesced'] += 1
+                leader = False
+
+        if not leader:
+            return flight.wait()
+
+        try:
+            flight.result = self.next(**kwargs)
+            return flight.result
+        except Exception, err:
+            flight.error = err
+            raise
+        finally:
+            with self.flights_lock:
+                del self.flights[key]
+            flight.event.set()
+
+    @classmethod
+    def count(cls, klasses, **counts):
+        """Adds C{counts} to the overall statistics and those of C{klasses}"""
+        with cls.stats_lock:
+            for name, amount in counts.iteritems():
+                cls.counters[name] += amount
+
+            for klass in klasses:
+                model = cls.model_counters.get(klass)
+                if model is None:
+                    model = cls.model_counters[klass] = { 'hits': 0,
+                            'misses': 0, 'negative_hits': 0, 'evictions': 0,
+                            'time_saved': 0.0 }
+                for name, amount in counts.iteritems():
+                    model[name] += amount
+
+    @classmethod
+    def notify(cls, event, *args):
+        for callback in cls.listeners[event]:
+            callback(*args)
+
+    @classmethod
+    def record_eviction(cls, key, tags):
+        """Store listener counting evictions for each tagged model class"""
+        cls.count(tags, evictions=1)
+        cls.notify('evict', key, tags)
+
+    @classmethod
+    def subscribe(cls, event, callback):
+        """
+        Calls C{callback} on each C{'hit'} or C{'miss'} with the relation and
+        cache key, or on each C{'evict'} with the cache key and its tags.
+
+        """
+        cls.listeners[event].append(callback)
+
+    @classmethod
+    def stats(cls):
+        """
+        Returns a dict of cache statistics.  The C{'models'} value maps each
+        model class to its own hits, misses, negative_hits, evictions and
+        time_saved (in seconds).
+
+        """
+        with cls.stats_lock:
+            stats = dict(cls.counters)
+            stats['models'] = dict((klass, dict(counts))
+                    for klass, counts in cls.model_counters.iteritems())
+
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = float(stats['hits']) / lookups if lookups else 0.0
+        stats['entries'] = len(cls.cache_store.store)
+        stats['bytes'] = cls.cache_store.bytes
+        return stats
+
+    @classmethod
+    def reset_stats(cls):
+        with cls.stats_lock:
+            for name in cls.counters:
+                cls.counters[name] = 0
+            cls.counters['time_saved'] = 0.0
+            cls.model_counters.clear()
+
+    @classmethod
+    def save_snapshot(cls, path, version=None):
+        """
+        Writes the live cache entries with their expiry times to the snapshot
+        file at C{path} and returns the number of entries written.  Entries
+        whose value can't be pickled are left out.  The C{version} given must
+        match when the snapshot is loaded.
+
+        """
+        index = {}
+        chunks = []
+        offset = 0
+        for key, val, expire_at, tags, stale_at, cost in (
+                cls.cache_store.entries()):
+            if not isinstance(key, basestring):
+                continue
+            if isinstance(val, SnapshotEntry):
+                data = val.raw()
+            else:
+                try:
+                    data = pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
+                except Exception:
+                    continue
+            tag_names = ['%s.%s' % (tag.__module__, tag.__name__)
+                         for tag in tags]
+            index[key] = (offset, len(data), expire_at, stale_at, cost,
+                          tag_names)
+            chunks.append(data)
+            offset += len(data)
+
+        header = pickle.dumps({ 'format': SNAPSHOT_FORMAT,
+                                'version': version,
+                                'index': index }, pickle.HIGHEST_PROTOCOL)
+
+        # Write to a temporary file of our own first so readers never see a
+        # partial file, even when several processes save at the same time
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                prefix='.snapshot-')
+        try:
+            snapshot = os.fdopen(fd, 'wb')
+            try:
+                snapshot.write(struct.pack('!Q', len(header)))
+                snapshot.write(header)
+                for chunk in chunks:
+                    snapshot.write(chunk)
+            finally:
+                snapshot.close()
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return len(index)
+
+    @classmethod
+    def load_snapshot(cls, path, version=None):
+        """
+        Loads the entries of a snapshot written by L{save_snapshot} into the
+        cache and returns the number of entries loaded.
+
+        The file is memory mapped and each value is only unpickled when it is
+        first read.  Nothing is loaded if the file is missing or unreadable,
+        or if it was written with a different C{version}.  Expired entries,
+        entries already in the cache and entries for model classes that are
+        no longer defined are skipped.
+
+        """
+        try:
+            snapshot = open(path, 'rb')
+            try:
+                data = mmap.mmap(snapshot.fileno(), 0,
+                        access=mmap.ACCESS_READ)
+            finally:
+                snapshot.close()
+            length = struct.unpack('!Q', data[:8])[0]
+            header = pickle.loads(data[8:8 + length])
+            index = header['index']
+        except Exception, err:
+            pyperry.logger.warn('CACHE SNAPSHOT NOT LOADED: %s' % err)
+            return 0
+
+        if (header.get('format') != SNAPSHOT_FORMAT or
+                header.get('version') != version):
+            return 0
+
+        loaded = 0
+        start = 8 + length
+        now = datetime.now()
+        for key, entry in index.iteritems():
+            offset, size, expire_at, stale_at, cost, tag_names = entry
+            if expire_at <= now or cls.cache_store.store.has_key(key):
+                continue
+            tags = [cls._resolve_model(name) for name in tag_names]
+            if None in tags:
+                continue
+
+            cls.cache_store.write(key,
+                    SnapshotEntry(data, start + offset, size),
+                    expire_at, set(tags), stale_at, cost)
+            loaded += 1
+
+        return loaded
+
+    @classmethod
+    def _resolve_model(cls, name):
+        """Returns the latest model class defined with the dotted name"""
+        module, class_name = name.rsplit('.', 1)
+        classes = [klass for klass in
+                   pyperry.base.BaseMeta.defined_models.get(class_name, [])
+                   if klass.__module__ == module]
+        if classes:
+            return classes[-1]
+
+    def tags_for(self, relation, records=None):
+        """
+        Returns the set of model classes the result of C{relation} depends on.
+        The classes of polymorphic belongs_to includes are only known per
+        record, so they are taken from the preloaded C{records} if given.
+
+        """
+        tags = set([relation.klass])
+        self._add_include_tags(relation.klass,
+                relation.query().get('includes'), tags, records or [])
+        return tags
+
+    def _add_include_tags(self, klass, includes, tags, records):
+        for association_id, nested in (includes or {}).iteritems():
+            association = klass.defined_associations.get(association_id)
+            if association is None:
+                continue
+            loaded = self._included_records(association, records)
+            if (association.type() == 'belongs_to' and
+                    association.polymorphic()):
+                # Polymorphic belongs_to sources are only known per record
+                by_class = {}
+                for record in loaded:
+                    by_class.setdefault(record.__class__, []).append(record)
+                for source, source_records in by_class.iteritems():
+                    tags.add(source)
+                    self._add_include_tags(source, nested, tags,
+                            source_records)
+                continue
+            try:
+                source = association.source_klass()
+            except errors.PerryError:
+                continue
+            if association.type() == 'has_many_through':
+                tags.add(association.proxy_association().source_klass())
+            tags.add(source)
+            self._add_include_tags(source, nested, tags, loaded)
+
+    def _included_records(self, association, records):
+        """Returns the records preloaded for association onto records"""
+        loaded = []
+        for record in records:
+            value = getattr(record, association.cache_id, None)
+            if isinstance(value, Relation):
+                loaded.extend(value._records or [])
+            elif isinstance(value, pyperry.Base):
+                loaded.append(value)
+        return loaded
 
 cache_store = LocalCache.cache_store
 
-caching.register(cache_store.empty)
+caching.register(cache_store.empty, cache_store.invalidate)
+cache_store.listeners.append(LocalCache.record_eviction)
 
 ##
 # Add features to Relation needed for caching
@@ -106,8 +962,7 @@ if not Relation.singular_query_methods.count('fresh'):
     def fresh(self, value=True):
         self = self.clone()
         self.params['fresh'] = value
-        self._query = None
-        self._records = None
+        self.reset()
         return self
 
     setattr(Relation, 'fresh', fresh)
@@ -1,5 +1,8 @@
 from pyperry.errors import ConfigurationError
 from pyperry import caching
+from pyperry import identity_map
+from pyperry import record_cache
+from pyperry import auto_preload
 
 class ModelBridge(object):
     """
@@ -13,7 +16,14 @@ class ModelBridge(object):
 
     On adapter reads, the C{ModelBridge} takes the list of records returned by
     the adapter call and creates a model instance of the appropriate type for
-    each record in the list.
+    each record in the list.  Inside an L{identity_scope
+    <pyperry.identity_map.identity_scope>} records that were already
+    instantiated during the scope are returned as the existing instance
+    (except for C{fresh} queries).  Records of models with a
+    L{record cache <pyperry.record_cache>} are added to it.  Streamed reads
+    are instantiated one record at a time as the caller iterates, and C{raw}
+    reads (see L{Relation.pluck <pyperry.relation.Relation.pluck>}) return the
+    raw records without instantiating them.
 
     On adapter writes and deletes, the C{ModelBridge} class updates the state
     of the model instance being saved or deleted to reflect the data stored in
@@ -26,6 +36,8 @@ class ModelBridge(object):
 
     """
 
+    features = { 'streaming': True }
+
     def __init__(self, next, options={}):
         self.next = next
         self.options = options
@@ -48,13 +60,37 @@ class ModelBridge(object):
         """Create perry.Base instances from the raw records dictionaries."""
         if 'relation' in kwargs:
             relation = kwargs['relation']
-            records = [relation.klass(record, False)
-                       for record in records if record]
+            if kwargs.get('stream'):
+                return self.stream_records(records, relation)
+            record_cache.add(relation, records)
+            if kwargs.get('raw'):
+                return [record for record in records if record]
+            instantiate = self.instantiator(relation)
+            records = [instantiate(record) for record in records if record]
+            auto_preload.attach(relation.klass, records)
         return records
 
+    def stream_records(self, records, relation):
+        """Generator instantiating each raw record as it is reached"""
+        instantiate = self.instantiator(relation)
+        for record in records:
+            if record:
+                record_cache.add(relation, [record])
+                yield instantiate(record)
+
+    def instantiator(self, relation):
+        """Returns a function creating a model instance from a raw record"""
+        identities = identity_map.current()
+        # Records read with a select are partial, so they are never shared
+        if (identities is None or relation.params.get('fresh') or
+                relation.query().get('select')):
+            return lambda record: relation.klass(record, False)
+        else:
+            return lambda record: identities.load(relation.klass, record)
+
     def handle_write(self, response, **kwargs):
         """Updates a model after a save."""
-        caching.reset()
+        self.expire_cache(**kwargs)
         if 'model' in kwargs:
             model = kwargs['model']
             if response.success:
@@ -89,15 +125,29 @@ class ModelBridge(object):
 
     def handle_delete(self, response, **kwargs):
         """Updates the model instance after a delete"""
-        caching.reset()
+        self.expire_cache(**kwargs)
         if 'model' in kwargs:
             model = kwargs['model']
             if response.success:
                 model.freeze()
+                identities = identity_map.current()
+                if identities is not None:
+                    identities.discard(model)
             else:
                 self.add_errors(response, model, 'record not deleted')
         return response
 
+    def expire_cache(self, **kwargs):
+        """
+        Invalidates cached reads for the class of the model being written.
+        Batch writes without a model reset all caches.
+
+        """
+        if 'model' in kwargs:
+            caching.invalidate(kwargs['model'].__class__)
+        else:
+            caching.reset()
+
     def add_errors(self, response, model, default_message):
         """
         Copies the response errors to the model or uses a default error
@@ -0,0 +1,70 @@
+"""
+Bounded parallel execution of adapter reads
+
+L{pmap} calls a function for each item on at most C{workers} threads and
+returns the results in the order of the items.  It is used to fetch chunks of
+large primary key lists and eager loaded associations concurrently, since
+these reads spend most of their time waiting on the data store.
+
+Worker threads join the L{identity scope <pyperry.identity_map>} of the
+calling thread, so records they read are shared with the caller.
+Other thread local state of the caller is not shared, so queries should be
+built before they are handed to the workers.  Concurrent reads are opt-in
+through the C{find_workers} and C{preload_workers} model options.
+
+"""
+import sys
+import threading
+import Queue
+
+from pyperry import identity_map
+
+def pmap(function, items, workers=4):
+    """
+    Returns C{[function(item) for item in items]}, running the calls on up to
+    C{workers} threads.  Calls run in the current thread when there is only
+    one item or one worker.  If any call raises, the first exception is
+    raised again once every call has finished.
+
+    """
+    items = list(items)
+    workers = min(workers or 1, len(items))
+    if workers <= 1:
+        return [function(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    identities = identity_map.current()
+
+    def run():
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = function(item)
+            except Exception:
+                errors.append((index, sys.exc_info()))
+
+    def work():
+        if identities is None:
+            run()
+        else:
+            with identity_map.identity_scope(identities):
+                run()
+
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        index, (klass, err, traceback) = min(errors)
+        raise klass, err, traceback
+    return results
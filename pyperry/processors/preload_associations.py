@@ -1,4 +1,41 @@
 from pyperry.errors import AssociationNotFound
+from pyperry.errors import AssociationPreloadNotSupported
+from pyperry import parallel
+from pyperry.relation import Relation
+
+class PreloadedRelation(Relation):
+    """
+    The relation set on each record for an eager loaded collection
+    association.  It holds the eager loaded records, but the association's
+    scope for the record is only built when the relation's query is used,
+    for example by chaining another query method onto it.
+
+    """
+
+    def __init__(self, association, owner, klass, records):
+        self.association = association
+        self.owner = owner
+        self.klass = klass
+        self._params = None
+        self._query = None
+        self._records = records
+        self._fingerprint = None
+        self._hash = None
+
+    def get_params(self):
+        if self._params is None:
+            scope = self.association.scope(self.owner)
+            if scope is None:
+                scope = Relation(self.klass)
+            self._params = scope.params
+        return self._params
+
+    def set_params(self, value):
+        self._params = value
+    params = property(get_params, set_params)
+
+    def clone(self):
+        return Relation(self)
 
 class PreloadAssociations(object):
     """
@@ -39,14 +76,41 @@ class PreloadAssociations(object):
             for story in reporter.stories():
                 print " - %s" % story.title
 
+    Polymorphic belongs_to associations are loaded with one query for each
+    type named by the records' C{<id>_type} field.
+
+    The associations in the includes are loaded one after another.  A model
+    may set C{preload_workers} to load them concurrently on up to that many
+    threads (see L{pyperry.parallel}), with nested includes starting as soon
+    as the records they belong to arrive.  The queries of each association
+    are then built and run on those threads, so lambdas in its scopes and
+    default scopes must not depend on thread local state of the calling
+    thread, like the current request's user.
+
+    When there are more than C{find_chunk_size} results (see
+    L{Relation.fetch_in <pyperry.relation.Relation.fetch_in>}), the records
+    of each association are loaded for chunks of that many results at a time,
+    so no single query carries an unbounded list of keys.  A model may set
+    C{find_workers} to load the chunks concurrently.  Each chunk's query is
+    built on the calling thread, but the queries of its nested includes are
+    built on the worker threads.
+
+    Records that were read without includes, for example records from a
+    cache or from several different queries, can be preloaded afterwards
+    with L{preload}.
+
     """
+    # Preloading needs every record of the result
+    features = { 'streaming': False }
+
     def __init__(self, next, options={}):
         self.next = next
         self.options = options
 
     def __call__(self, **kwargs):
         results = self.next(**kwargs)
-        if kwargs['mode'] == 'read' and len(results) > 0:
+        if (kwargs['mode'] == 'read' and not kwargs.get('raw') and
+                len(results) > 0):
             self.do_preload(results, **kwargs)
         return results
 
@@ -58,37 +122,239 @@ class PreloadAssociations(object):
         rel = kwargs['relation']
         includes = rel.query().get('includes') or {}
 
+        associations = []
         for association_id in includes.keys():
             association = rel.klass.defined_associations.get(association_id)
             if association is None: raise AssociationNotFound(
                     "unkown association: %s" % association_id)
-            scope = association.scope(results)
-            scope = scope.includes(includes[association_id])
-            eager_records = scope.all({'modifiers': rel.modifiers_value()})
+            associations.append(association)
+
+        # Sibling associations may be loaded concurrently.  Nested includes
+        # are preloaded by the query of their parent association, so each
+        # branch continues as soon as its own records arrive.
+        def load(association):
+            if association.type() == 'has_many_through':
+                loader = self.load_through_records
+            elif self.polymorphic_belongs_to(association):
+                loader = self.load_polymorphic_records
+            else:
+                loader = self.load_records
+            return loader(rel, association, results,
+                    includes[association.id])
+
+        loaded = parallel.pmap(load, associations,
+                rel._find_option('preload_workers'))
 
-            for result in results:
-                self.add_records_to_scope(association, eager_records, result)
+        for association, eager_records in zip(associations, loaded):
+            if association.type() == 'has_many_through':
+                klass = association.source_klass()
+                for result, records in zip(results, eager_records):
+                    setattr(result, association.id,
+                            PreloadedRelation(association, result, klass,
+                                records))
+            elif self.polymorphic_belongs_to(association):
+                for result, record in zip(results, eager_records):
+                    setattr(result, association.id, record)
+            else:
+                self.add_records_to_scopes(association, eager_records,
+                        results)
 
-    def add_records_to_scope(self, association, records, result):
+    def load_records(self, rel, association, results, includes):
         """
-        Caches the eager loaded records on the matching target model and
-        association along with the corresponding scope.
+        Loads the association's records for results, in chunks of
+        C{find_chunk_size} results if there are more than that.
 
         """
-        scope = association.scope(result)
-        pk = association.primary_key()
+        size = rel._find_option('find_chunk_size')
+        chunks = [results[i:i + size] for i in range(0, len(results), size)]
+        modifiers = rel.modifiers_value()
+
+        def relation(chunk):
+            scope = association.scope(chunk)
+            if includes:
+                scope = scope.includes(includes)
+            scope = scope.apply_finder_options({'modifiers': modifiers})
+            # Build the query here so its lambdas run on the calling thread
+            scope.query()
+            return scope
+
+        if len(chunks) <= 1:
+            return relation(results).fetch_records()
+
+        records = []
+        seen = set()
+        loaded = parallel.pmap(lambda scope: scope.fetch_records(),
+                [relation(chunk) for chunk in chunks],
+                rel._find_option('find_workers'))
+        for record in [record for chunk in loaded for record in chunk]:
+            # Chunks can share belongs_to records
+            key = (record.__class__, record.pk_value())
+            if key[1] is None or key not in seen:
+                seen.add(key)
+                records.append(record)
+        return records
+
+    def load_through_records(self, rel, association, results, includes):
+        """
+        Loads the records of a has many through association for results with
+        two queries: one for the proxy records of every result, then one for
+        the source records of every proxy record (split into chunks of
+        C{find_chunk_size} keys if needed).  Returns the list of source
+        records for each result, in the order of results.
+
+        """
+        proxy = association.proxy_association()
+        source = association.source_association()
+        proxy_records = self.load_records(rel, proxy, results, None)
+
+        relation = association.source_klass().scoped()
+        if rel.modifiers_value():
+            relation = relation.modifiers(rel.modifiers_value())
+        if includes:
+            relation = relation.includes(includes)
+
+        if source.type() == 'belongs_to':
+            proxy_key = source.foreign_key
+            record_key = source.primary_key(association.options.get(
+                    'source_type'))
+        else:
+            proxy_key = source.primary_key()
+            record_key = source.foreign_key
+            if source.polymorphic():
+                relation = relation.where({ source.polymorphic_type():
+                        proxy.source_klass().__name__ })
+
+        keys = [getattr(record, proxy_key) for record in proxy_records]
+        keys = [key for key in keys if key is not None]
+        records = relation.fetch_in(record_key, keys) if keys else []
+
+        index = {}
+        for record in records:
+            index.setdefault(getattr(record, record_key), []).append(record)
+
+        loaded = []
+        for proxies in self.match_records(proxy, proxy_records, results):
+            matches = []
+            seen = set()
+            for proxy_record in proxies:
+                for record in index.get(getattr(proxy_record, proxy_key), []):
+                    if id(record) not in seen:
+                        seen.add(id(record))
+                        matches.append(record)
+            loaded.append(matches)
+        return loaded
+
+    def polymorphic_belongs_to(self, association):
+        return association.type() == 'belongs_to' and association.polymorphic()
+
+    def load_polymorphic_records(self, rel, association, results, includes):
+        """
+        Loads the records of a polymorphic belongs_to association for results
+        by grouping the results on their type field and querying each type's
+        class once, concurrently for different types on up to
+        C{preload_workers} threads.  Returns the record (or None) for each
+        result, in the order of results.
+
+        """
+        if association.dynamic_options():
+            raise AssociationPreloadNotSupported(
+                    "This association cannot be eager loaded. It has a "
+                    "config with callables.")
+
+        type_attr = association.polymorphic_type()
         fk = association.foreign_key
+        keys = {}
+        for result in results:
+            poly_type = getattr(result, type_attr)
+            key = getattr(result, fk)
+            if poly_type and key is not None:
+                keys.setdefault(poly_type, []).append(key)
 
-        if association.type() is 'belongs_to':
-            scope._records = [record for record in records if
-                             getattr(record, pk) == getattr(result, fk)]
+        modifiers = rel.modifiers_value()
+
+        def load(poly_type):
+            relation = association._base_scope(poly_type)
+            if modifiers:
+                relation = relation.modifiers(modifiers)
+            if includes:
+                relation = relation.includes(includes)
+            pk = association.primary_key(poly_type)
+            records = relation.fetch_in(pk, keys[poly_type])
+            return dict((getattr(record, pk), record) for record in records)
 
+        types = keys.keys()
+        loaded = dict(zip(types, parallel.pmap(load, types,
+                rel._find_option('preload_workers'))))
+
+        return [loaded.get(getattr(result, type_attr), {}).get(
+                    getattr(result, fk)) for result in results]
+
+    def match_records(self, association, records, results):
+        """
+        Returns the list of records matching each result for the association.
+        The records are indexed by the key they are matched on once, so each
+        result is matched with a single lookup.
+
+        """
+        pk = association.primary_key()
+        fk = association.foreign_key
+        if association.type() is 'belongs_to':
+            record_key, result_key = pk, fk
         else: # has_one, has_many
-            scope._records = [record for record in records if
-                             getattr(record, fk) == getattr(result, pk)]
+            record_key, result_key = fk, pk
+
+        index = {}
+        for record in records:
+            index.setdefault(getattr(record, record_key), []).append(record)
+
+        return [index.get(getattr(result, result_key), [])
+                for result in results]
+
+    def add_records_to_scopes(self, association, records, results):
+        """
+        Caches the eager loaded records on each matching target model for the
+        association.  Collections are cached as a L{PreloadedRelation}.
+
+        """
+        collection = association.collection()
+        if collection:
+            klass = association.source_klass()
 
-        scope_value = scope
-        if not association.collection():
-            scope_value = scope._records[0] if len(scope._records) > 0 else None
+        matched = self.match_records(association, records, results)
+        for result, matches in zip(results, matched):
+            if collection:
+                value = PreloadedRelation(association, result, klass,
+                        list(matches))
+            else:
+                value = matches[0] if matches else None
+            setattr(result, association.id, value)
+
+
+def preload(records, *includes):
+    """
+    Eager loads the associations named by includes onto records that are
+    already loaded, as if they had been read with C{includes(*includes)}::
+
+        articles = cached_articles + Article.where(draft=True).all()
+        pyperry.preload(articles, 'author', {'comments': 'user'})
+
+    Records of different models may be mixed; the associations are loaded
+    for the records of each model together.  Returns records.
+
+    """
+    by_class = {}
+    classes = []
+    for record in records:
+        if record is None:
+            continue
+        klass = record.__class__
+        if klass not in by_class:
+            by_class[klass] = []
+            classes.append(klass)
+        by_class[klass].append(record)
 
-        setattr(result, association.id, scope_value)
+    processor = PreloadAssociations(None)
+    for klass in classes:
+        processor.do_preload(by_class[klass],
+                relation=Relation(klass).includes(*includes))
+    return records
@@ -0,0 +1,128 @@
+"""
+Primary key record cache
+
+Models that set a C{record_cache_interval} (in seconds) keep the raw record
+of every read result passing through the L{ModelBridge} in a cache keyed by
+model class and primary key::
+
+    class Person(pyperry.Base):
+        id = Field()
+        record_cache_interval = 60
+
+Queries that only look up records by primary key, such as
+C{Person.find(1)}, C{Person.find([1, 2, 3])} or loading a C{belongs_to}
+association, are then answered from the cache.  Only the keys that are not
+cached are fetched through the read adapter.  Queries with any other
+conditions or options (including default scopes) always use the adapter, and
+results of queries with a C{select} value are not cached because their
+records may be incomplete.
+
+Entries are tagged with their model class, so L{caching.invalidate} clears
+them when a model of that class is written.
+
+"""
+from datetime import datetime, timedelta
+
+from pyperry import caching
+from pyperry import identity_map
+from pyperry.middlewares.local_cache import CacheStore
+from pyperry.relation import QueryValues
+
+store = CacheStore(300)
+
+caching.register(store.empty, store.invalidate)
+
+def enabled(klass):
+    return getattr(klass, 'record_cache_interval', None) is not None
+
+def add(relation, records):
+    """Caches the raw records read for relation"""
+    klass = relation.klass
+    if not enabled(klass) or relation.query().get('select'):
+        return
+
+    pk_attr = klass.primary_key()
+    expire_at = datetime.now() + timedelta(
+            seconds=klass.record_cache_interval)
+    for record in records:
+        if record and record.get(pk_attr) is not None:
+            store.write((klass, record[pk_attr]), dict(record), expire_at,
+                    [klass])
+
+def lookup_keys(relation):
+    """
+    Returns the list of primary keys if relation is a plain primary key
+    lookup or None otherwise.
+
+    """
+    query = relation.query()
+    if set(query.keys()) - set(['where', 'limit']):
+        return None
+
+    where = query.get('where') or []
+    pk_attr = relation.klass.primary_key()
+    if len(where) != 1 or not isinstance(where[0], dict):
+        return None
+    if where[0].keys() != [pk_attr]:
+        return None
+
+    keys = where[0][pk_attr]
+    if not isinstance(keys, list):
+        keys = [keys]
+    return keys
+
+def fetch(relation):
+    """
+    Returns the records for a primary key lookup, fetching only the keys
+    missing from the cache, or None if relation can't be served from the
+    cache.
+
+    """
+    klass = relation.klass
+    if not enabled(klass):
+        return None
+    keys = lookup_keys(relation)
+    if keys is None:
+        return None
+
+    records = {}
+    missing = []
+    for key in keys:
+        if key in records or key in missing:
+            continue
+        record = store.read((klass, key))
+        if record is None:
+            missing.append(key)
+        else:
+            records[key] = _instantiate(klass, record)
+
+    fetched = []
+    if missing:
+        rel = relation.clone()
+        rel.params['where'] = QueryValues([{klass.primary_key(): missing}])
+        rel.params['limit'] = None
+        fetched = klass.reader(relation=rel, mode='read')
+        for record in fetched:
+            records.setdefault(record.pk_value(), record)
+
+    # Return records in the requested order
+    results = []
+    seen = set()
+    for key in keys:
+        if key in records and key not in seen:
+            results.append(records[key])
+            seen.add(key)
+    # Fetched records whose key didn't match the requested value's type
+    results += [record for record in fetched if record.pk_value() not in seen
+                and record not in results]
+
+    limit = relation.query().get('limit')
+    if limit is not None:
+        results = results[:limit]
+    return results
+
+def _instantiate(klass, record):
+    identities = identity_map.current()
+    if identities is None:
+        return klass(dict(record), False)
+    return identities.load(klass, dict(record))
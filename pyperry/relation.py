@@ -1,6 +1,11 @@
-from copy import copy, deepcopy
+from copy import copy
+import hashlib
+import itertools
+import re
 from pyperry.errors import ArgumentError, RecordNotFound, PersistenceError
-from pyperry.errors import ConfigurationError
+from pyperry.errors import ConfigurationError, BrokenAdapterStack
+from pyperry.field import Field
+from pyperry import parallel
 
 class DelayedMerge(object):
     """
@@ -16,6 +21,129 @@ class DelayedMerge(object):
     def __call__(self, *args, **kwargs):
         return self.obj.merge(self.func(*args, **kwargs))
 
+# Marks a value that is evaluated each time a query is built
+LAMBDA = ('lambda',)
+
+def _shape(value, evaluated=True):
+    """
+    Return a hashable description of a query value that is equal for values
+    that build the same query.  Callables that L{Relation.query} evaluates are
+    replaced with L{LAMBDA} so relations built by the same scope share a
+    shape even though each holds its own lambda.
+
+    """
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted(
+            (_shape(k, False), _shape(v, False))
+            for k, v in value.iteritems())))
+    elif isinstance(value, (list, QueryValues)):
+        return ('list', tuple(_shape(v, evaluated) for v in value))
+    elif isinstance(value, tuple):
+        return ('tuple', tuple(_shape(v, False) for v in value))
+    elif evaluated and callable(value):
+        return LAMBDA
+    elif hasattr(value, 'pattern') and hasattr(value, 'flags'):
+        return ('regex', value.pattern, value.flags)
+    else:
+        return (value.__class__, value)
+
+def _is_static(shape):
+    """Return True if the shape has no values evaluated per query"""
+    if shape == LAMBDA:
+        return False
+    elif isinstance(shape, tuple):
+        return all(_is_static(item) for item in shape)
+    return True
+
+
+class QueryValues(object):
+    """
+    An immutable sequence of the values passed to a plural query method.
+
+    Extending a C{QueryValues} returns a new instance that only holds the new
+    values and points back at the instance it was extended from, so a chain
+    of query methods shares the values accumulated so far instead of copying
+    them at each step.  The flattened tuple of values is built on first use
+    and memoized.  C{QueryValues} compare equal to lists and tuples holding
+    the same values.
+
+    """
+    __slots__ = ('values', 'parent', 'length', '_items', '_shape')
+
+    def __init__(self, values=(), parent=None):
+        self.values = tuple(values)
+        self.parent = parent
+        self.length = len(self.values)
+        if parent is not None:
+            self.length += parent.length
+        self._items = None
+        self._shape = None
+
+    def extend(self, values):
+        """Return a new C{QueryValues} with values added to the end"""
+        values = tuple(values)
+        if not values:
+            return self
+        elif not self.length:
+            return QueryValues(values)
+        return QueryValues(values, self)
+
+    def items(self):
+        """Return all values as a tuple"""
+        if self._items is None:
+            chunks = []
+            node = self
+            while node is not None:
+                if node._items is not None:
+                    chunks.append(node._items)
+                    break
+                chunks.append(node.values)
+                node = node.parent
+            chunks.reverse()
+            self._items = tuple(itertools.chain.from_iterable(chunks))
+        return self._items
+
+    def shape(self):
+        """Return the memoized L{_shape} of the values"""
+        if self._shape is None:
+            self._shape = _shape(self)
+        return self._shape
+
+    def __iter__(self):
+        return iter(self.items())
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self.items()[index])
+        return self.items()[index]
+
+    def __add__(self, other):
+        return self.extend(other)
+
+    def __radd__(self, other):
+        return QueryValues(tuple(other) + self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (QueryValues, list, tuple)):
+            return self.items() == tuple(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return hash(self.items())
+
+    def __repr__(self):
+        return repr(list(self.items()))
+
+
 class Relation(object):
     """
     Relations
@@ -93,12 +221,32 @@ class Relation(object):
           L{query} method, so the modifiers will not be passed on to the data
           store.
 
+    Relations are immutable once built: query methods return a new relation
+    that shares the values of the relation it was called on (see
+    L{QueryValues}), so chaining is cheap.  Relations for the same model with
+    the same query values are equal and hash alike, so they can be used as
+    dict keys or set members.
+
     Finder methods
     ==============
 
         - B{L{first}:} return all records represented by the current relation
         - B{L{all}:} return only the first record represented by the currennt
           relation
+        - B{L{find_each}:} iterate over all records represented by the current
+          relation, fetching them in batches
+        - B{L{find_in_batches}:} iterate over lists of records represented by
+          the current relation
+        - B{L{stream}:} iterate over all records represented by the current
+          relation in a single streamed read
+        - B{L{count}:} return the number of records represented by the
+          current relation
+        - B{L{exists}:} return True if the current relation represents any
+          records
+        - B{L{pluck}:} return the values of the given fields for each record
+          without instantiating models
+        - B{L{values}:} return a dict of field values for each record without
+          instantiating models
 
     Finder options
     ==============
@@ -122,19 +270,34 @@ class Relation(object):
     plural_query_methods = ['select', 'group', 'order', 'joins', 'includes',
             'where', 'having']
     aliases = { 'from_': 'from', 'conditions': 'where' }
+    # Query methods whose values are combined without regard to order
+    unordered_query_methods = ['where', 'having']
+
+    # Compiled query plans shared by all relations, see query()
+    query_plans = {}
+    max_query_plans = 1000
+
+    # Defaults for fetching long key lists, see fetch_in().  Models may
+    # override them with class attributes of the same name.
+    find_chunk_size = 1000
+    find_workers = 1
+    # Threads for loading sibling includes, see PreloadAssociations
+    preload_workers = 1
 
     def __init__(self, klass_or_relation):
         """Set klass this relation object is mapped to"""
         self.params = {}
         self._query = None
         self._records = None
+        self._fingerprint = None
+        self._hash = None
 
         if isinstance(klass_or_relation, Relation):
-            # Copy constructor
+            # Copy constructor: the params values are immutable, so only the
+            # top level dict needs to be copied
             relation = klass_or_relation
             self.klass = relation.klass
             self.params.update(relation.params)
-            self.params = self._copy_params(self.params)
         else:
             # assume a Base instance
             self.klass = klass_or_relation
@@ -142,8 +305,8 @@ class Relation(object):
             for method in self.singular_query_methods:
                 self.params[method] = None
             for method in self.plural_query_methods:
-                self.params[method] = []
-            self.params['modifiers'] = []
+                self.params[method] = QueryValues()
+            self.params['modifiers'] = QueryValues()
 
     # Dynamically create the query methods as they are needed
     def __getattr__(self, key):
@@ -169,10 +332,46 @@ class Relation(object):
         for item in self.fetch_records():
             yield(item)
 
-    # Delgates array indexing and splicing to records list
+    # Delgates array indexing and splicing to records list.  Unless the
+    # records are already loaded, non-negative indexes and slices without a
+    # step only fetch the records they select using offset and limit.
     def __getitem__(self, index):
+        if self._records is None and not self.params['sql']:
+            if isinstance(index, slice):
+                start, stop = index.start or 0, index.stop
+                if (index.step in (None, 1) and start >= 0 and
+                        (stop is None or stop >= 0)):
+                    return self._slice(start, stop).fetch_records()
+            elif isinstance(index, (int, long)) and index >= 0:
+                records = self._slice(index, index + 1).fetch_records()
+                if not records:
+                    raise IndexError('list index out of range')
+                return records[0]
         return self.fetch_records().__getitem__(index)
 
+    def _slice(self, start, stop):
+        """
+        Returns a relation for the records from start up to stop (or the end
+        if stop is None) of this relation's records
+        """
+        query = self.query()
+        offset = query.get('offset') or 0
+        limit = query.get('limit')
+
+        if limit is not None:
+            stop = limit if stop is None else min(stop, limit)
+        if stop is not None:
+            stop = max(stop, start)
+            if stop == start:
+                rel = self.clone()
+                rel._records = []
+                return rel
+
+        rel = self.offset(offset + start) if offset + start else self
+        if stop is not None:
+            rel = rel.limit(stop - start)
+        return rel
+
     # Delegates len() to the records list
     def __len__(self):
         return len(self.fetch_records())
@@ -198,6 +397,100 @@ class Relation(object):
         """
         return self.apply_finder_options(options, **kwargs).fetch_records()
 
+    def count(self, options={}, **kwargs):
+        """
+        Apply any finder options passed and return the number of matching
+        records.  If the read adapter supports counting (see
+        L{AbstractAdapter<pyperry.adapter.abstract_adapter>}) the count is
+        requested from it, otherwise every record is fetched and counted.
+        """
+        if self._records is not None and not (options or kwargs):
+            return len(self._records)
+
+        rel = self.apply_finder_options(options, **kwargs)
+        reader = getattr(rel.klass, 'reader', None)
+        if getattr(reader, 'features', {}).get('count'):
+            return reader(relation=rel, mode='count')
+        return len(rel)
+
+    def exists(self, options={}, **kwargs):
+        """
+        Apply any finder options passed and return True if any records match,
+        fetching at most one record
+        """
+        if self._records is not None and not (options or kwargs):
+            return len(self._records) > 0
+        rel = self.apply_finder_options(options, **kwargs)
+        return len(rel.limit(1).fetch_records()) > 0
+
+    def pluck(self, *attrs):
+        """
+        Returns the values of the given fields for each matching record as a
+        list of tuples, or a list of values if only one field is given::
+
+            Person.where(age=24).pluck('id', 'name')
+            # => [(1, 'Ann'), (2, 'Bob')]
+
+        Only the given fields are selected from the adapter and records are
+        never instantiated as models, so no callbacks run.  Values are still
+        deserialized by their L{Field}.
+        """
+        if not attrs:
+            raise ArgumentError('pluck requires at least one field')
+        fields = self._raw_fields(attrs)
+        records = self.select(*[name for attr, name, field in fields])
+        values = [tuple(self._raw_value(record, name, field)
+                        for attr, name, field in fields)
+                  for record in records._fetch_raw_records()]
+        if len(attrs) == 1:
+            return [value[0] for value in values]
+        return values
+
+    def values(self, *attrs):
+        """
+        Returns a dict of field values for each matching record without
+        instantiating models.  If fields are given only those fields are
+        selected from the adapter, otherwise every defined field is included.
+        """
+        if attrs:
+            fields = self._raw_fields(attrs)
+            rel = self.select(*[name for attr, name, field in fields])
+        else:
+            fields = self._raw_fields(sorted(self.klass.defined_fields))
+            rel = self
+        return [dict((attr, self._raw_value(record, name, field))
+                     for attr, name, field in fields)
+                for record in rel._fetch_raw_records()]
+
+    def _raw_fields(self, attrs):
+        """
+        Returns an (attribute, raw record key, Field or None) tuple for each
+        attribute name
+        """
+        fields = []
+        for attr in attrs:
+            field = getattr(self.klass, attr, None)
+            if isinstance(field, Field):
+                fields.append((attr, field.name, field))
+            else:
+                fields.append((attr, attr, None))
+        return fields
+
+    def _raw_value(self, record, name, field):
+        value = record.get(name)
+        if field is not None:
+            value = field.deserialize(value)
+        return value
+
+    def _fetch_raw_records(self):
+        """Execute the query returning the raw records from the adapter"""
+        if not hasattr(self.klass, 'reader'):
+            raise ConfigurationError(
+                    "You must set `reader` attribute to an instance of "
+                    "pyperry.adapters.AbstractAdapter in order to fetch "
+                    "records")
+        return self.klass.reader(relation=self, mode='read', raw=True)
+
     def find(self, pks_or_mode, options={}, **kwargs):
         """
         Returns a record or list of records matching the primary key or array
@@ -205,16 +498,23 @@ class Relation(object):
         one of 'first' or 'all', the C{first} or C{all} finder methods
         respectively are called with the given finder options from the second
         argument.
+
+        A list of primary keys returns a relation holding the records in the
+        order of the keys, however many keys are given (see L{fetch_in}).
         """
         if pks_or_mode == 'all':
             return self.all(options, **kwargs)
         elif pks_or_mode == 'first':
             return self.first(options, **kwargs)
         elif isinstance(pks_or_mode, list):
-            result = self.where({self.klass.primary_key(): pks_or_mode})
-            if len(result) < len(pks_or_mode):
+            pk = self.klass.primary_key()
+            keys = self._unique(pks_or_mode)
+            result = self.where({pk: keys})
+            result._records = self._in_key_order(keys,
+                    self.fetch_in(pk, keys))
+            if len(result) < len(keys):
                 raise RecordNotFound(
-                        self._record_not_found_message(pks_or_mode, result))
+                        self._record_not_found_message(keys, result))
             return result
         elif isinstance(pks_or_mode, str) or isinstance(pks_or_mode, int):
             result = self.where({self.klass.primary_key(): pks_or_mode}).first()
@@ -225,6 +525,186 @@ class Relation(object):
         else:
             raise ArgumentError('unkown arguments for find method')
 
+    def find_in_batches(self, batch_size=1000, options={}, **kwargs):
+        """
+        Generator yielding the records matching this relation and the given
+        finder options as lists of at most C{batch_size} records, so large
+        result sets can be processed without loading them all at once.
+
+        Batches are fetched with C{limit} and C{offset}.  If the read adapter
+        supports L{keyset paging <pyperry.adapter.abstract_adapter>}, they
+        are fetched with keyset pagination instead: the relation is ordered
+        by the primary key and each batch is queried with a C{where}
+        condition selecting the records after the last primary key seen.  A
+        relation already ordered by its primary key alone, ascending or
+        descending, keeps that order.  Relations with any other order, a
+        C{limit} or an C{offset} are always paged with C{limit} and
+        C{offset}.
+
+        """
+        rel = self.apply_finder_options(options, **kwargs)
+        if batch_size < 1:
+            raise ArgumentError('batch_size must be a positive integer')
+
+        if rel.params['sql']:
+            records = rel.fetch_records()
+            for start in range(0, len(records), batch_size):
+                yield records[start:start + batch_size]
+            return
+
+        query = rel.query()
+        reader = getattr(rel.klass, 'reader', None)
+        direction = rel._keyset_direction(query.get('order'))
+        if (getattr(reader, 'features', {}).get('keyset') and direction and
+                not (query.get('limit') or query.get('offset'))):
+            batches = rel._keyset_batches(batch_size, direction)
+        else:
+            batches = rel._offset_batches(batch_size)
+
+        for batch in batches:
+            yield batch
+
+    def find_each(self, batch_size=1000, options={}, **kwargs):
+        """
+        Generator yielding each record matching this relation and the given
+        finder options.  Records are fetched C{batch_size} at a time by
+        L{find_in_batches}.
+
+        """
+        for batch in self.find_in_batches(batch_size, options, **kwargs):
+            for record in batch:
+                yield record
+
+    def stream(self, options={}, **kwargs):
+        """
+        Apply any finder options passed and execute the query as a streamed
+        read, returning a generator of records.  Records are instantiated as
+        the adapter produces them and are not kept on the relation, so large
+        results can be processed in constant memory when the adapter stack
+        supports L{streaming <pyperry.adapter.abstract_adapter>}.
+
+        """
+        rel = self.apply_finder_options(options, **kwargs)
+        return rel.klass.stream_records(rel)
+
+    def _keyset_direction(self, order):
+        """
+        Returns '>' or '<' if records can be paged on the primary key with the
+        given order values or None if they can't.
+
+        """
+        if not order:
+            return '>'
+        elif len(order) == 1 and isinstance(order[0], basestring):
+            match = re.match(r'^\s*%s(?:\s+(asc|desc))?\s*$' %
+                    re.escape(self.klass.primary_key()), order[0], re.I)
+            if match:
+                direction = (match.group(1) or 'asc').lower()
+                return '<' if direction == 'desc' else '>'
+
+    def _keyset_batches(self, batch_size, direction):
+        """Generator for find_in_batches using keyset pagination"""
+        pk = self.klass.primary_key()
+        rel = self.limit(batch_size)
+        if not rel.params['order']:
+            rel = rel.order(pk)
+
+        page = rel
+        last = None
+        while True:
+            batch = page.fetch_records()
+            if batch and last is not None:
+                # An adapter ignoring the condition would repeat a batch
+                # forever
+                value = batch[-1].pk_value()
+                if not (value > last if direction == '>' else value < last):
+                    raise BrokenAdapterStack(
+                            'keyset page did not move past %s %r' %
+                            (pk, last))
+            if batch:
+                yield batch
+            if len(batch) < batch_size:
+                break
+            last = batch[-1].pk_value()
+            page = rel.where('%s %s %s' %
+                    (pk, direction, self._sql_literal(last)))
+
+    def _offset_batches(self, batch_size):
+        """Generator for find_in_batches using limit and offset pagination"""
+        query = self.query()
+        offset = query.get('offset') or 0
+        remaining = query.get('limit')
+
+        while remaining is None or remaining > 0:
+            size = batch_size
+            if remaining is not None:
+                size = min(size, remaining)
+                remaining -= size
+            batch = self.limit(size).offset(offset).fetch_records()
+            if batch:
+                yield batch
+            if len(batch) < size:
+                break
+            offset += size
+
+    def _sql_literal(self, value):
+        """Format a primary key value for use in a SQL condition"""
+        if isinstance(value, (int, long)) and not isinstance(value, bool):
+            return str(value)
+        elif isinstance(value, float):
+            return repr(value)
+        if not isinstance(value, basestring):
+            value = str(value)
+        return "'%s'" % value.replace("'", "''")
+
+    def fetch_in(self, attr, keys):
+        """
+        Returns the records of this relation whose C{attr} value is one of
+        C{keys}.  Duplicate keys are only sent once, and long key lists are
+        split into chunks of C{find_chunk_size} keys.  The chunks are fetched
+        one after another unless the model sets C{find_workers}, in which
+        case they are fetched concurrently on up to that many threads (see
+        L{pyperry.parallel}).  Each chunk's query is built on the calling
+        thread, so lambdas in its scopes see the caller's thread local state.
+        Records are returned in the order of the chunks.
+        """
+        keys = self._unique(keys)
+        size = self._find_option('find_chunk_size')
+        chunks = [keys[i:i + size] for i in range(0, len(keys), size)]
+        if len(chunks) <= 1:
+            return self.where({attr: keys}).fetch_records()
+
+        relations = [self.where({attr: chunk}) for chunk in chunks]
+        for relation in relations:
+            relation.query()
+        results = parallel.pmap(lambda relation: relation.fetch_records(),
+                relations, self._find_option('find_workers'))
+        return [record for records in results for record in records]
+
+    def _find_option(self, option):
+        """Returns the model's value for option or the Relation default"""
+        return getattr(self.klass, option, getattr(Relation, option))
+
+    def _in_key_order(self, keys, records):
+        """
+        Returns records in the order of their primary keys in keys.  Records
+        whose primary key isn't one of keys, like an integer key requested
+        as a string, follow in the order they were read.
+        """
+        positions = dict((key, index) for index, key in enumerate(keys))
+        return sorted(records, key=lambda record:
+                positions.get(record.pk_value(), len(keys)))
+
+    def _unique(self, keys):
+        """Returns keys without duplicates, keeping their order"""
+        seen = set()
+        unique = []
+        for key in keys:
+            if key not in seen:
+                seen.add(key)
+                unique.append(key)
+        return unique
+
     def update_all(self, args=None, **kwargs):
         if args is None:
             args = {}
@@ -292,16 +772,15 @@ class Relation(object):
         """Merge given relation onto self returning a new relation"""
         self = self.clone()
 
-        query_methods = (self.singular_query_methods +
-                         self.plural_query_methods +
-                         ['modifiers'])
+        for method in self.singular_query_methods:
+            value = relation.params.get(method)
+            if value:
+                self.params[method] = value
 
-        for method in query_methods:
+        for method in self.plural_query_methods + ['modifiers']:
             value = relation.params[method]
-            if value and isinstance(value, list):
-                self = getattr(self, method)(*value)
-            elif value:
-                self = getattr(self, method)(value)
+            if value:
+                self.params[method] = self.params[method] + value
 
         return self
 
@@ -309,25 +788,115 @@ class Relation(object):
         """
         Return the query dictionary.  This is used to form the dictionary of
         values used in the fetch_records call.
+
+        The values without lambdas are normalized once per distinct query
+        shape and kept in a compiled plan in C{query_plans}, so relations
+        built by the same chain of query methods only evaluate their lambdas.
         """
         if self._query: return self._query
 
-        self._query = {}
-        query_methods = [method for method in
-                (self.plural_query_methods + self.singular_query_methods)
-                if method is not 'includes']
-
-        for method in query_methods:
-            value = self.params[method]
+        static, dynamic = self._query_plan()
+        # The plan's lists and dicts are shared, so each query gets copies
+        # the adapter stack may modify
+        self._query = dict((method, copy(value))
+                           if isinstance(value, (list, dict))
+                           else (method, value)
+                           for method, value in static.iteritems())
+
+        for method in dynamic:
+            if method == 'includes':
+                value = self.includes_value()
+            else:
+                value = self._eval_lambdas(self.params[method])
             if value:
-                self._query[method] = self._eval_lambdas(value)
-
-        value = self.includes_value()
-        if value:
-            self._query['includes'] = value
+                self._query[method] = value
 
         return self._query
 
+    def _query_plan(self):
+        """
+        Return a (static, dynamic) pair where static is a dict of the query
+        values that contain no lambdas and dynamic is a list of the query
+        methods that must be evaluated for each query.
+
+        """
+        methods = self.plural_query_methods + self.singular_query_methods
+        try:
+            shapes = []
+            for method in methods:
+                value = self.params[method]
+                if isinstance(value, QueryValues):
+                    shapes.append(value.shape())
+                else:
+                    shapes.append(_shape(value))
+            key = (self.klass, tuple(shapes))
+            plan = self.query_plans.get(key)
+        except TypeError:
+            # Some value is unhashable so the plan can't be shared
+            key = plan = None
+            shapes = [LAMBDA] * len(methods)
+
+        if plan is None:
+            static = {}
+            dynamic = []
+            for method, shape in zip(methods, shapes):
+                if not _is_static(shape):
+                    dynamic.append(method)
+                elif method == 'includes':
+                    value = self.includes_value()
+                    if value:
+                        static[method] = value
+                elif self.params[method]:
+                    static[method] = self._eval_lambdas(self.params[method])
+            plan = (static, dynamic)
+
+            if key is not None:
+                if len(self.query_plans) >= self.max_query_plans:
+                    self.query_plans.clear()
+                self.query_plans[key] = plan
+
+        return plan
+
+    def fingerprint(self):
+        """
+        Return a stable hex digest identifying the model class and query.
+
+        Nested dicts, lists and compiled regular expressions are normalized
+        into a canonical form before hashing, and the values of
+        C{unordered_query_methods} are sorted, so relations that are logically
+        identical share a fingerprint regardless of dict ordering or the order
+        of chained C{where} calls.  The result is memoized on the relation.
+
+        """
+        if self._fingerprint is None:
+            query = self.query()
+            canonical = []
+            for method in sorted(query.keys()):
+                value = self._canonical(query[method])
+                if method in self.unordered_query_methods:
+                    value = ('list', tuple(sorted(value[1])))
+                canonical.append((method, value))
+
+            key = "%s.%s--%r" % (self.klass.__module__, self.klass.__name__,
+                    tuple(canonical))
+            self._fingerprint = hashlib.sha1(key).hexdigest()
+        return self._fingerprint
+
+    def _canonical(self, value):
+        """Convert value into nested tuples with a deterministic repr"""
+        if isinstance(value, dict):
+            return ('dict', tuple(sorted(
+                (self._canonical(k), self._canonical(v))
+                for k, v in value.iteritems())))
+        elif isinstance(value, (list, tuple, QueryValues)):
+            return ('list', tuple(self._canonical(v) for v in value))
+        elif isinstance(value, (set, frozenset)):
+            return ('set', tuple(sorted(self._canonical(v) for v in value)))
+        elif hasattr(value, 'pattern') and hasattr(value, 'flags'):
+            return ('regex', value.pattern, value.flags)
+        else:
+            return value
+
     def fetch_records(self):
         """Perform the query and return the resulting list (aliased as list)"""
         if self._records is None:
@@ -396,24 +965,6 @@ class Relation(object):
                 a[k] = v
         return a
 
-    def _copy_params(self, params):
-        """
-        Recursively copy structure with dict or list elements.  This was added
-        because deepmerge() doesn't work correctly with re objects.
-        """
-        if isinstance(params, dict):
-            params = copy(params)
-            for key in params:
-                params[key] = self._copy_params(params[key])
-            return params
-        elif isinstance(params, list):
-            params = copy(params)
-            for i in range(len(params)):
-                params[i] = self._copy_params(params[i])
-            return params
-        else:
-            return copy(params)
-
 
     def modifiers(self, value):
         """
@@ -432,9 +983,9 @@ class Relation(object):
         """
         rel = self.clone()
         if value is None:
-            rel.params['modifiers'] = []
+            rel.params['modifiers'] = QueryValues()
         else:
-            rel.params['modifiers'].append(value)
+            rel.params['modifiers'] = rel.params['modifiers'] + [value]
         return rel
 
     def modifiers_value(self):
@@ -478,9 +1029,9 @@ class Relation(object):
         """
         def method(self, *value, **kwargs):
             self = self.clone()
-            self.params[key] += list(value)
             if len(kwargs) > 0:
-                self.params[key].append(kwargs)
+                value += (kwargs,)
+            self.params[key] = self.params[key] + value
             return self
 
         method.__name__ = key
@@ -492,13 +1043,33 @@ class Relation(object):
     def reset(self):
         self._records = None
         self._query = None
+        self._fingerprint = None
+        self._hash = None
+
+    def __eq__(self, other):
+        if not isinstance(other, Relation):
+            return NotImplemented
+        return (self is other or (self.klass is other.klass and
+                self._canonical(self.params) ==
+                other._canonical(other.params)))
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash((self.klass, self._canonical(self.params)))
+        return self._hash
 
     def __repr__(self):
         return("<Relation for %s Query: %s>" %
                 (self.klass.__name__, str(self.params)) )
 
     def _eval_lambdas(self, value):
-        if type(value).__name__ == 'list':
+        if type(value).__name__ in ('list', 'QueryValues'):
             return [ self._eval_lambdas(item) for item in value ]
         elif callable(value):
             return value()
@@ -230,6 +230,38 @@ class CallModeTestCase(AdapterBaseTestCase):
         kwargs = self.adapter(mode='delete')
         self.assertEqual(kwargs['mode'], 'delete')
 
+class StreamingTestCase(AdapterBaseTestCase):
+
+    def setUp(self):
+        class StreamingAdapter(AbstractAdapter):
+            def __init__(self, *args, **kwargs):
+                super(StreamingAdapter, self).__init__(*args, **kwargs)
+                self.features['streaming'] = True
+            def stack(self, **kwargs): return [kwargs.get('stream')]
+        class StreamingMiddleware(MiddlewareTestBase):
+            features = { 'streaming': True }
+        self.adapter = StreamingAdapter({})
+        self.StreamingMiddleware = StreamingMiddleware
+
+    def test_streamable(self):
+        """should be streamable if every stack item supports streaming"""
+        self.assertTrue(self.adapter.streamable)
+        self.adapter.middlewares = [(self.StreamingMiddleware, {})]
+        self.assertTrue(self.adapter.streamable)
+        self.adapter.processors = [ProcessorA]
+        self.assertFalse(self.adapter.streamable)
+
+    def test_adapter_without_streaming(self):
+        """should not be streamable if the adapter doesn't stream"""
+        self.assertFalse(AbstractAdapter({}).streamable)
+
+    def test_stream_kwarg(self):
+        """should only pass stream on when the stack is streamable"""
+        self.assertEqual(self.adapter(mode='read', stream=True), [True])
+        self.adapter.middlewares = [(MiddlewareA, {})]
+        self.assertEqual(self.adapter(mode='read', stream=True), [False])
+
+
 class MergeMethodTestCase(AdapterBaseTestCase):
 
     def test_exists(self):
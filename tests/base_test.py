@@ -593,7 +593,7 @@ class BaseScopedMethodTestCase(BaseScopingTestCase):
         """
         rel = self.Test.scoped()
         self.assertEqual(type(rel).__name__, 'Relation')
-        self.assertNotEqual(hash(self.Test.relation()), hash(rel))
+        self.assertFalse(self.Test.relation() is rel)
 
         self.Test._scoped_methods = [ rel.where('foo') ]
         self.assertEqual(self.Test.scoped().params['where'], ['foo'])
@@ -0,0 +1,36 @@
+import tests
+import unittest
+from nose.plugins.skip import SkipTest
+
+import pyperry
+try:
+    from pyperry.adapter.bertrpc_adapter import BERTRPC
+except ImportError:
+    BERTRPC = None
+
+class BERTRPCCountTestCase(unittest.TestCase):
+
+    def setUp(self):
+        if BERTRPC is None:
+            raise SkipTest('bertrpc is not available')
+        self.adapter = BERTRPC({ 'namespace': 'perry', 'procedure': 'read',
+                                 'count_procedure': 'count',
+                                 'base_options': { 'scope': 'all' } })
+        self.calls = []
+        def call_server(options, procedure=None):
+            self.calls.append((options, procedure))
+            return '5'
+        self.adapter._call_server = call_server
+
+    def test_feature(self):
+        """should support counting when a count_procedure is configured"""
+        self.assertTrue(self.adapter.features['count'])
+        adapter = BERTRPC({ 'namespace': 'perry', 'procedure': 'read' })
+        self.assertFalse(adapter.features['count'])
+
+    def test_count(self):
+        """should call the count procedure in count mode"""
+        relation = pyperry.Base.scoped().where('foo')
+        self.assertEqual(self.adapter.count(relation=relation), 5)
+        self.assertEqual(self.calls, [({ 'where': ['foo'], 'scope': 'all',
+                                         'mode': 'count' }, 'count')])
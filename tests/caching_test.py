@@ -31,5 +31,32 @@ class CachingReset(CachingTestCase):
         caching.reset()
         self.assertEqual(self.called, True)
 
-
-
+class CachingInvalidate(CachingTestCase):
+
+    def tearDown(self):
+        for item in [self.reset_only, self.with_invalidator]:
+            if item in caching.registry:
+                caching.registry.remove(item)
+
+    def reset_only(self):
+        self.calls.append('reset_only')
+
+    def with_invalidator(self):
+        self.calls.append('with_invalidator')
+
+    def test_calls_invalidators(self):
+        """should pass classes to invalidators instead of resetting"""
+        self.calls = []
+        invalidated = []
+        caching.register(self.with_invalidator,
+                lambda *klasses: invalidated.extend(klasses))
+        caching.invalidate(str, int)
+        self.assertEqual(invalidated, [str, int])
+        self.assertEqual(self.calls, [])
+
+    def test_falls_back_to_reset(self):
+        """should reset registry items without an invalidator"""
+        self.calls = []
+        caching.register(self.reset_only)
+        caching.invalidate(str)
+        self.assertEqual(self.calls, ['reset_only'])
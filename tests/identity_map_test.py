@@ -0,0 +1,148 @@
+import tests
+import unittest
+import gc
+import threading
+import time
+
+import pyperry
+from pyperry import identity_map
+from pyperry.field import Field
+from pyperry.middlewares import ModelBridge
+from tests.fixtures.test_adapter import TestAdapter, SuccessAdapter
+
+class IdentityMapBaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class Test(pyperry.Base):
+            id = Field()
+            name = Field()
+            reader = TestAdapter()
+            writer = TestAdapter()
+        self.Test = Test
+        TestAdapter.data = { 'id': 1, 'name': 'foo' }
+
+    def tearDown(self):
+        TestAdapter.reset_calls()
+
+
+class IdentityScopeTestCase(IdentityMapBaseTestCase):
+
+    def test_exported(self):
+        self.assertEqual(pyperry.identity_scope, identity_map.identity_scope)
+
+    def test_no_scope(self):
+        """should build new instances outside of a scope"""
+        self.assertEqual(identity_map.current(), None)
+        self.assertFalse(self.Test.first() is self.Test.first())
+
+    def test_same_instance(self):
+        """should return the existing instance for a known primary key"""
+        with pyperry.identity_scope():
+            record = self.Test.first()
+            TestAdapter.data = { 'id': 1, 'name': 'bar' }
+            self.assertTrue(self.Test.where('foo').first() is record)
+            self.assertEqual(record.name, 'foo')
+
+    def test_different_keys(self):
+        with pyperry.identity_scope():
+            record = self.Test.first()
+            TestAdapter.data = { 'id': 2 }
+            self.assertFalse(self.Test.first() is record)
+
+    def test_select_bypasses_map(self):
+        """should not share instances built from partial select reads"""
+        with pyperry.identity_scope():
+            TestAdapter.data = { 'id': 1 }
+            partial = self.Test.select('id').first()
+            TestAdapter.data = { 'id': 1, 'name': 'bob' }
+            record = self.Test.first()
+            self.assertFalse(record is partial)
+            self.assertEqual(record.name, 'bob')
+
+    def test_scope_ends(self):
+        """should forget instances when the scope exits"""
+        with pyperry.identity_scope():
+            record = self.Test.first()
+        self.assertEqual(identity_map.current(), None)
+        self.assertFalse(self.Test.first() is record)
+
+    def test_nested_scopes(self):
+        """should share the outer map with nested scopes"""
+        with pyperry.identity_scope() as outer:
+            with pyperry.identity_scope() as inner:
+                self.assertTrue(inner is outer)
+            self.assertTrue(identity_map.current() is outer)
+
+    def test_thread_local(self):
+        """should not share a scope with other threads"""
+        seen = []
+        with pyperry.identity_scope():
+            thread = threading.Thread(
+                    target=lambda: seen.append(identity_map.current()))
+            thread.start()
+            thread.join()
+        self.assertEqual(seen, [None])
+
+    def test_weak_references(self):
+        """should not keep instances alive"""
+        with pyperry.identity_scope() as identities:
+            record = self.Test.first()
+            self.assertEqual(len(identities), 1)
+            del record
+            gc.collect()
+            self.assertEqual(len(identities), 0)
+
+    def test_fresh_bypasses_map(self):
+        """should build new instances for fresh queries so reload works"""
+        with pyperry.identity_scope():
+            record = self.Test.first()
+            TestAdapter.data = { 'id': 1, 'name': 'bar' }
+            record.reload()
+            self.assertEqual(record.name, 'bar')
+
+    def test_discards_deleted(self):
+        """should remove deleted models from the map"""
+        self.Test.writer = SuccessAdapter()
+        with pyperry.identity_scope() as identities:
+            record = self.Test.first()
+            ModelBridge(SuccessAdapter())(model=record, mode='delete')
+            self.assertEqual(identities.get(self.Test, 1), None)
+
+
+class IdentityMapLoadTestCase(IdentityMapBaseTestCase):
+
+    def test_missing_primary_key(self):
+        """should always build records without a primary key value"""
+        identities = identity_map.IdentityMap()
+        record1 = identities.load(self.Test, { 'name': 'foo' })
+        record2 = identities.load(self.Test, { 'name': 'foo' })
+        self.assertFalse(record1 is record2)
+        self.assertEqual(len(identities), 0)
+
+    def test_new_record_false(self):
+        identities = identity_map.IdentityMap()
+        record = identities.load(self.Test, { 'id': 1 })
+        self.assertEqual(record.new_record, False)
+        self.assertTrue(identities.get(self.Test, 1) is record)
+
+    def test_concurrent_loads(self):
+        """should build one instance when threads load the same record"""
+        class SlowTest(self.Test):
+            def __init__(self, *args, **kwargs):
+                time.sleep(0.01)
+                super(SlowTest, self).__init__(*args, **kwargs)
+
+        identities = identity_map.IdentityMap()
+        start = threading.Event()
+        records = []
+        def load():
+            start.wait()
+            records.append(identities.load(SlowTest, { 'id': 1 }))
+        threads = [threading.Thread(target=load) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(id(record) for record in records)), 1)
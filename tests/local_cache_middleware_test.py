@@ -1,11 +1,19 @@
 import tests
 import unittest
+import threading
+import time
+import os
+import shutil
+import tempfile
 from datetime import datetime, timedelta
 
 import pyperry
 from pyperry.middlewares import LocalCache
 from tests.fixtures.test_adapter import TestAdapter
 from pyperry.middlewares.local_cache import CacheStore
+from pyperry.middlewares.local_cache import LRUPolicy, TinyLFUPolicy
+from pyperry.middlewares.local_cache import CompactResult
+from pyperry.middlewares.local_cache import SnapshotEntry
 from pyperry.field import Field
 from pyperry import caching
 
@@ -53,6 +61,22 @@ class LocalCacheInstalledTestCase(LocalCacheBaseTestCase):
         self.assertEqual(len(self.cache.store.keys()), 1)
         self.assertEqual(self.cache.store.values()[0][0], [record.fields])
 
+    def test_passes_other_modes_through(self):
+        """should not cache calls that are not reads"""
+        cache = LocalCache(lambda **kwargs: 5)
+        self.assertEqual(cache(mode='count', relation=self.Test.scoped()), 5)
+        self.assertEqual(len(self.cache.store.keys()), 0)
+
+    def test_passes_raw_reads_through(self):
+        """should not share entries between raw and instantiated reads"""
+        class Processed(pyperry.Base):
+            id = Field()
+            reader = TestAdapter(processors=[(LocalCache, {})])
+        self.assertEqual(Processed.pluck('id'), [1])
+        records = Processed.select('id').all()
+        self.assertTrue(isinstance(records[0], Processed))
+        self.assertEqual(Processed.select('id').pluck('id'), [1])
+
     def test_recalls_result_from_cache(self):
         """should recall stored value from cache"""
         record1 = self.Test.first()
@@ -97,6 +121,86 @@ class LocalCacheInstalledTestCase(LocalCacheBaseTestCase):
 
 
 
+    def test_empty_results_not_cached(self):
+        """should not cache empty results without a negative_interval"""
+        TestAdapter.count = 0
+        self.Test.first()
+        self.Test.first()
+        self.assertEqual(len(TestAdapter.calls), 2)
+        self.assertEqual(len(self.cache.store), 0)
+
+    def test_negative_interval(self):
+        """should cache empty results for negative_interval seconds"""
+        self.Test.reader.middlewares = [
+                (LocalCache, { 'interval': 300, 'negative_interval': 10 })]
+        LocalCache.counters['negative_hits'] = 0
+        TestAdapter.count = 0
+        self.assertEqual(self.Test.first(), None)
+        self.assertEqual(self.Test.first(), None)
+        self.assertEqual(len(TestAdapter.calls), 1)
+        self.assertEqual(LocalCache.counters['negative_hits'], 1)
+
+        expire_at = self.cache.store.values()[0][1]
+        diff = abs(expire_at - (datetime.now() + timedelta(seconds=10)))
+        self.assertTrue(diff < timedelta(seconds=1))
+
+    def test_negative_entries_invalidated(self):
+        """should clear cached empty results on write invalidation"""
+        self.Test.reader.middlewares = [
+                (LocalCache, { 'negative_interval': 10 })]
+        TestAdapter.count = 0
+        self.Test.first()
+        caching.invalidate(self.Test)
+        self.Test.first()
+        self.assertEqual(len(TestAdapter.calls), 2)
+
+    def test_hit_keeps_expiry(self):
+        """should not push back an entry's expiry when it is read"""
+        self.Test.first()
+        expire_at = self.cache.store.values()[0][1]
+        self.Test.first()
+        self.assertEqual(self.cache.store.values()[0][1], expire_at)
+
+    def test_tags_with_model_class(self):
+        """should tag cache entries with the relation's class"""
+        self.Test.first()
+        key = self.cache.store.keys()[0]
+        self.assertEqual(self.cache.entry_tags[key], set([self.Test]))
+
+    def test_tags_include_classes(self):
+        """should tag cache entries with classes reached through includes"""
+        from tests.fixtures.association_models import Site, Article, Comment
+        from tests.fixtures.association_models import Person
+        l = LocalCache(None)
+        rel = Site.includes({'articles': 'comments'}, 'maintainer')
+        self.assertEqual(l.tags_for(rel),
+                set([Site, Article, Comment, Person]))
+
+    def test_tags_polymorphic_includes(self):
+        """should tag entries with classes of polymorphic preloads"""
+        from tests.fixtures.association_models import Site, Article, Comment
+        l = LocalCache(None)
+        rel = Comment.includes('parent')
+        comments = [Comment({ 'id': 1 }), Comment({ 'id': 2 }),
+                    Comment({ 'id': 3 })]
+        comments[0].parent = Site({ 'id': 1 })
+        comments[1].parent = Article({ 'id': 1 })
+        comments[2].parent = None
+        self.assertEqual(l.tags_for(rel), set([Comment]))
+        self.assertEqual(l.tags_for(rel, comments),
+                set([Comment, Site, Article]))
+
+    def test_invalidate_by_class(self):
+        """should only drop entries for the invalidated class"""
+        class Other(pyperry.Base):
+            id = Field()
+            reader = TestAdapter(middlewares=[(LocalCache, {})])
+
+        self.Test.first()
+        Other.first()
+        caching.invalidate(Other)
+        self.assertEqual(self.cache.entry_tags.values(), [set([self.Test])])
+
     def test_force_cache_refresh(self):
         """should force cache refresh if fresh query option present"""
         rel = self.Test.scoped()
@@ -105,6 +209,443 @@ class LocalCacheInstalledTestCase(LocalCacheBaseTestCase):
         self.assertEqual(len(TestAdapter.calls), 2)
 
 
+class LocalCacheStatsTestCase(LocalCacheBaseTestCase):
+
+    def setUp(self):
+        TestAdapter.data = { 'id': 1 }
+        self.cache = pyperry.middlewares.local_cache.cache_store
+        class Test(pyperry.Base):
+            id = Field()
+            reader = TestAdapter(middlewares=[(LocalCache, {})])
+        self.Test = Test
+        LocalCache.reset_stats()
+        self.listeners = dict((k, list(v))
+                for k, v in LocalCache.listeners.iteritems())
+
+    def tearDown(self):
+        self.cache.empty()
+        self.cache.configure()
+        TestAdapter.reset_calls()
+        LocalCache.reset_stats()
+        LocalCache.listeners.update(self.listeners)
+
+    def test_hits_and_misses(self):
+        """should count hits and misses overall and per model"""
+        self.Test.first()
+        self.Test.first()
+        self.Test.first()
+        stats = LocalCache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertAlmostEqual(stats['hit_ratio'], 2.0 / 3)
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['models'][self.Test]['hits'], 2)
+        self.assertEqual(stats['models'][self.Test]['misses'], 1)
+
+    def test_time_saved(self):
+        """should add the cost of the original fetch to time_saved on hits"""
+        self.Test.first()
+        key = self.cache.store.keys()[0]
+        self.cache.costs[key] = 0.5
+        self.Test.first()
+        self.Test.first()
+        self.assertEqual(LocalCache.stats()['time_saved'], 1.0)
+        self.assertEqual(
+                LocalCache.stats()['models'][self.Test]['time_saved'], 1.0)
+
+    def test_evictions(self):
+        """should count evictions for the evicted entry's models"""
+        self.cache.configure(max_entries=1)
+        self.Test.first()
+        self.Test.where('foo').first()
+        stats = LocalCache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['models'][self.Test]['evictions'], 1)
+
+    def test_bytes(self):
+        """should report bytes held when the store measures sizes"""
+        self.cache.configure(measure_bytes=True)
+        self.Test.first()
+        self.assertTrue(LocalCache.stats()['bytes'] > 0)
+
+    def test_callbacks(self):
+        """should call subscribed callbacks on hit, miss and evict"""
+        events = []
+        LocalCache.subscribe('hit', lambda rel, key: events.append('hit'))
+        LocalCache.subscribe('miss', lambda rel, key: events.append('miss'))
+        LocalCache.subscribe('evict',
+                lambda key, tags: events.append(('evict', tags)))
+        self.cache.configure(max_entries=1)
+        self.Test.first()
+        self.Test.first()
+        self.Test.where('foo').first()
+        self.assertEqual(events,
+                ['miss', 'hit', 'miss', ('evict', set([self.Test]))])
+
+    def test_reset_stats(self):
+        self.Test.first()
+        LocalCache.reset_stats()
+        stats = LocalCache.stats()
+        self.assertEqual(stats['misses'], 0)
+        self.assertEqual(stats['models'], {})
+
+
+class LocalCacheSerializeTestCase(LocalCacheBaseTestCase):
+
+    def setUp(self):
+        TestAdapter.data = { 'id': 1 }
+        self.cache = pyperry.middlewares.local_cache.cache_store
+        class Test(pyperry.Base):
+            id = Field()
+            reader = TestAdapter(middlewares=[
+                (LocalCache, { 'serialize': True })])
+        self.Test = Test
+
+    def tearDown(self):
+        self.cache.empty()
+        TestAdapter.reset_calls()
+
+    def test_stores_compact_result(self):
+        """should store the encoded records instead of the result list"""
+        record = self.Test.first()
+        entry = self.cache.store.values()[0][0]
+        self.assertTrue(isinstance(entry, CompactResult))
+        self.assertEqual(entry.codec, 'marshal')
+        self.assertEqual(entry.decode(), [record.fields])
+
+    def test_hit_returns_copy(self):
+        """should decode a new copy of the records on every hit"""
+        record1 = self.Test.first()
+        record1.fields['id'] = 5
+        record2 = self.Test.first()
+        self.assertEqual(record2.id, 1)
+        self.assertEqual(len(TestAdapter.calls), 1)
+
+
+class LocalCacheSnapshotTestCase(LocalCacheBaseTestCase):
+
+    def setUp(self):
+        self.path = tempfile.mktemp()
+        self.store = LocalCache.cache_store
+        self.store.empty()
+        self.expire_at = datetime.now() + timedelta(minutes=5)
+        class Snapshot(pyperry.Base): pass
+        self.Snapshot = Snapshot
+        self.store.write('foo', [{ 'id': 1 }], self.expire_at,
+                set([Snapshot]))
+
+    def tearDown(self):
+        self.store.empty()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_round_trip(self):
+        """should load saved entries lazily and decode them on first read"""
+        self.assertEqual(LocalCache.save_snapshot(self.path), 1)
+        self.store.empty()
+
+        self.assertEqual(LocalCache.load_snapshot(self.path), 1)
+        self.assertTrue(isinstance(self.store.store['foo'][0],
+                SnapshotEntry))
+        self.assertEqual(self.store.store['foo'][1], self.expire_at)
+        self.assertEqual(self.store.entry_tags['foo'],
+                set([self.Snapshot]))
+
+        self.assertEqual(self.store.read('foo'), [{ 'id': 1 }])
+        self.assertEqual(self.store.store['foo'][0], [{ 'id': 1 }])
+
+    def test_remeasure_decoded_entries(self):
+        """should measure entries again once they are decoded"""
+        LocalCache.save_snapshot(self.path)
+        self.store.empty()
+        self.store.configure(measure_bytes=True)
+        try:
+            LocalCache.load_snapshot(self.path)
+            self.store.read('foo')
+            size = self.store.size_of(self.store.store['foo'][0])
+            self.assertEqual(self.store.sizes['foo'], size)
+            self.assertEqual(self.store.bytes, size)
+        finally:
+            self.store.configure()
+
+    def test_no_temporary_files_left(self):
+        """should rename its own temporary file over the snapshot"""
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'cache.snapshot')
+        try:
+            LocalCache.save_snapshot(path)
+            LocalCache.save_snapshot(path)
+            self.assertEqual(os.listdir(directory), ['cache.snapshot'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_resave_loaded_entries(self):
+        """should save entries that were loaded but never read"""
+        LocalCache.save_snapshot(self.path)
+        self.store.empty()
+        LocalCache.load_snapshot(self.path)
+        LocalCache.save_snapshot(self.path)
+        self.store.empty()
+
+        LocalCache.load_snapshot(self.path)
+        self.assertEqual(self.store.read('foo'), [{ 'id': 1 }])
+
+    def test_version_mismatch(self):
+        """should not load a snapshot saved with another version"""
+        LocalCache.save_snapshot(self.path, version='1.0')
+        self.store.empty()
+        self.assertEqual(LocalCache.load_snapshot(self.path, '2.0'), 0)
+        self.assertEqual(LocalCache.load_snapshot(self.path, '1.0'), 1)
+
+    def test_skip_expired(self):
+        """should skip entries that expired since the snapshot was saved"""
+        self.store.write('bar', [], datetime.now() + timedelta(seconds=1))
+        LocalCache.save_snapshot(self.path)
+        self.store.empty()
+        time.sleep(1)
+        self.assertEqual(LocalCache.load_snapshot(self.path), 1)
+        self.assertFalse(self.store.store.has_key('bar'))
+
+    def test_skip_undefined_models(self):
+        """should skip entries tagged with models that are not defined"""
+        class Gone(pyperry.Base): pass
+        Gone.__module__ = 'tests.removed_module'
+        self.store.write('bar', [], self.expire_at, set([Gone]))
+        LocalCache.save_snapshot(self.path)
+        self.store.empty()
+        pyperry.base.BaseMeta.defined_models['Gone'].remove(Gone)
+
+        self.assertEqual(LocalCache.load_snapshot(self.path), 1)
+        self.assertFalse(self.store.store.has_key('bar'))
+
+    def test_missing_or_corrupt_file(self):
+        """should load nothing from a missing or corrupt snapshot"""
+        self.assertEqual(LocalCache.load_snapshot(self.path), 0)
+        f = open(self.path, 'wb')
+        f.write('not a snapshot')
+        f.close()
+        self.assertEqual(LocalCache.load_snapshot(self.path), 0)
+
+
+class CompactResultTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class Test(pyperry.Base):
+            id = Field()
+            name = Field()
+        self.Test = Test
+
+    def test_records(self):
+        result = [{ 'id': 1, 'name': 'foo' }, { 'id': 2, 'name': None }]
+        entry = CompactResult(result)
+        self.assertEqual(entry.decode(), result)
+        self.assertFalse(entry.decode() is entry.decode())
+
+    def test_models(self):
+        """should store model fields and rebuild the models"""
+        result = [self.Test({ 'id': 1, 'name': 'foo' }, False)]
+        records = CompactResult(result).decode(self.Test)
+        self.assertEqual(records, result)
+        self.assertEqual(records[0].new_record, False)
+
+    def test_pickle_fallback(self):
+        """should pickle values marshal can't encode"""
+        now = datetime.now()
+        entry = CompactResult([{ 'at': now }])
+        self.assertEqual(entry.codec, 'pickle')
+        self.assertEqual(entry.decode(), [{ 'at': now }])
+
+    def test_compress_threshold(self):
+        result = [{ 'name': 'x' * 1000 }]
+        self.assertFalse(CompactResult(result).compressed)
+        entry = CompactResult(result, 'pickle', 100)
+        self.assertTrue(entry.compressed)
+        self.assertTrue(len(entry.data) < 100)
+        self.assertEqual(entry.decode(), result)
+
+    def test_size(self):
+        """should report the encoded size to the store"""
+        entry = CompactResult([{ 'name': 'x' * 1000 }])
+        self.assertTrue(CacheStore(10).size_of(entry) > 1000)
+
+
+class LocalCacheSingleFlightTestCase(LocalCacheBaseTestCase):
+
+    def setUp(self):
+        class Test(pyperry.Base):
+            id = Field()
+        self.relation = Test.scoped()
+        self.release = threading.Event()
+        self.calls = []
+        LocalCache.counters.update({ 'fetches': 0, 'coalesced': 0 })
+
+    def tearDown(self):
+        LocalCache.cache_store.empty()
+
+    def slow_next(self, **kwargs):
+        self.calls.append(kwargs)
+        self.release.wait(5)
+        return [{ 'id': 1 }]
+
+    def run_threads(self, cache, count):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+                cache(relation=self.relation, mode='read')))
+                for i in range(count)]
+        for thread in threads:
+            thread.start()
+
+        deadline = time.time() + 5
+        while (LocalCache.counters['coalesced'] < count - 1 and
+                time.time() < deadline):
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_coalesces_misses(self):
+        """should make one fetch for concurrent misses of the same key"""
+        cache = LocalCache(self.slow_next, { 'single_flight': True })
+        results = self.run_threads(cache, 5)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(results, [[{ 'id': 1 }]] * 5)
+        self.assertEqual(LocalCache.counters['fetches'], 1)
+        self.assertEqual(LocalCache.counters['coalesced'], 4)
+        self.assertEqual(LocalCache.flights, {})
+
+    def test_shares_errors(self):
+        """should raise the fetch error in every waiting thread"""
+        def failing_next(**kwargs):
+            self.release.wait(5)
+            raise ValueError('boom')
+
+        cache = LocalCache(failing_next, { 'single_flight': True })
+        errors = []
+        def run():
+            try:
+                cache(relation=self.relation, mode='read')
+            except ValueError, err:
+                errors.append(err)
+        threads = [threading.Thread(target=run) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        deadline = time.time() + 5
+        while LocalCache.counters['coalesced'] < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(LocalCache.flights, {})
+
+    def test_disabled_by_default(self):
+        """should not track flights unless single_flight is set"""
+        self.release.set()
+        LocalCache(self.slow_next)(relation=self.relation, mode='read')
+        self.assertEqual(LocalCache.counters['fetches'], 0)
+
+
+class LocalCacheStaleWhileRevalidateTestCase(LocalCacheBaseTestCase):
+
+    def setUp(self):
+        class Test(pyperry.Base):
+            id = Field()
+        self.relation = Test.scoped()
+        self.calls = []
+        self.value = [{ 'id': 1 }]
+        self.cache = LocalCache(self.next, { 'stale_ttl': 60 })
+        LocalCache.counters.update({ 'refreshes': 0, 'refreshes_dropped': 0 })
+        LocalCache.stop_refresher()
+
+    def tearDown(self):
+        LocalCache.cache_store.empty()
+        LocalCache.stop_refresher()
+
+    def next(self, **kwargs):
+        self.calls.append(kwargs)
+        return self.value
+
+    def make_stale(self):
+        key = self.relation.fingerprint()
+        store = LocalCache.cache_store
+        store.stale_times[key] = datetime.now() - timedelta(seconds=1)
+
+    def test_writes_stale_time(self):
+        """should keep entries for stale_ttl seconds past their interval"""
+        self.cache(relation=self.relation, mode='read')
+        key = self.relation.fingerprint()
+        store = LocalCache.cache_store
+        stale_at = store.stale_times[key]
+        self.assertEqual(store.store[key][1] - stale_at,
+                timedelta(seconds=60))
+        self.assertFalse(store.stale(key))
+
+    def test_serves_stale_and_refreshes(self):
+        """should return a stale entry and refresh it in the background"""
+        self.cache(relation=self.relation, mode='read')
+        self.make_stale()
+        self.value = [{ 'id': 2 }]
+
+        result = self.cache(relation=self.relation, mode='read')
+        self.assertEqual(result, [{ 'id': 1 }])
+        LocalCache.refresher.queue.join()
+
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(LocalCache.counters['refreshes'], 1)
+        result = self.cache(relation=self.relation, mode='read')
+        self.assertEqual(result, [{ 'id': 2 }])
+        self.assertFalse(LocalCache.cache_store.stale(
+                self.relation.fingerprint()))
+
+    def test_bounded_queue(self):
+        """should drop refreshes when the queue is full"""
+        release = threading.Event()
+        def blocked_next(**kwargs):
+            release.wait(5)
+            return self.value
+        cache = LocalCache(blocked_next, { 'stale_ttl': 60,
+            'refresh_queue_size': 1 })
+        release.set()
+        relations = [self.relation.where(str(i)) for i in range(4)]
+        for rel in relations:
+            cache(relation=rel, mode='read')
+            LocalCache.cache_store.stale_times[rel.fingerprint()] = (
+                    datetime.now() - timedelta(seconds=1))
+
+        release.clear()
+        for rel in relations:
+            cache(relation=rel, mode='read')
+        release.set()
+        LocalCache.refresher.queue.join()
+
+        self.assertTrue(LocalCache.counters['refreshes'] <= 2)
+        self.assertTrue(LocalCache.counters['refreshes_dropped'] >= 2)
+
+    def test_shared_refresher(self):
+        """should refresh through one set of threads for every instance"""
+        other = LocalCache(self.next, { 'stale_ttl': 60 })
+        self.cache(relation=self.relation, mode='read')
+        self.make_stale()
+        self.cache(relation=self.relation, mode='read')
+        refresher = LocalCache.refresher
+        other(relation=self.relation, mode='read')
+        self.assertTrue(LocalCache.refresher is refresher)
+        refresher.queue.join()
+        self.assertEqual(len(refresher.workers), 1)
+
+    def test_stop_refresher(self):
+        """should end the refresh threads when stopped"""
+        self.cache(relation=self.relation, mode='read')
+        self.make_stale()
+        self.cache(relation=self.relation, mode='read')
+        workers = LocalCache.refresher.workers
+        LocalCache.stop_refresher()
+        self.assertEqual(LocalCache.refresher, None)
+        self.assertFalse(any(worker.is_alive() for worker in workers))
+        self.assertEqual(len(self.calls), 2)
+
+
 ##
 # Test the in memory caching structure
 #
@@ -183,6 +724,132 @@ class CacheStoreEmptyMethodTestCase(CacheStoreBaseTestCase):
         self.assertEqual(len(self.store.store.keys()), 0)
 
 
+class CacheStoreBoundsTestCase(CacheStoreBaseTestCase):
+
+    def test_max_entries(self):
+        """should evict the least recently used entry past max_entries"""
+        self.store.configure(max_entries=2)
+        self.store.write('foo', 1)
+        self.store.write('bar', 2)
+        self.store.read('foo')
+        self.store.write('baz', 3)
+        self.assertEqual(set(self.store.store.keys()), set(['foo', 'baz']))
+        self.assertEqual(self.store.evictions, 1)
+
+    def test_max_bytes(self):
+        """should evict entries to stay under max_bytes"""
+        value = 'x' * 100
+        size = self.store.size_of(value)
+        self.store.configure(max_bytes=size * 2)
+        for key in ['a', 'b', 'c']:
+            self.store.write(key, value)
+        self.assertEqual(self.store.store.keys(), ['b', 'c'])
+        self.assertEqual(self.store.bytes, size * 2)
+
+    def test_oversized_entry(self):
+        """should not store entries larger than max_bytes"""
+        self.store.configure(max_bytes=10)
+        self.store.write('foo', 'x' * 100)
+        self.assertEqual(self.store.read('foo'), None)
+        self.assertEqual(self.store.bytes, 0)
+
+    def test_configure_shrinks(self):
+        """should evict existing entries when limits are lowered"""
+        for key in ['a', 'b', 'c']:
+            self.store.write(key, key)
+        self.store.configure(max_entries=1)
+        self.assertEqual(self.store.store.keys(), ['c'])
+
+    def test_expiry_without_scan(self):
+        """should drop stale heap items for rewritten keys"""
+        for i in range(100):
+            self.store.write('foo', i)
+        self.assertEqual(len(self.store.store), 1)
+        self.assertTrue(len(self.store.expiry) <= 66)
+
+    def test_lru_default(self):
+        self.assertTrue(isinstance(self.store.policy, LRUPolicy))
+
+
+class TinyLFUPolicyTestCase(CacheStoreBaseTestCase):
+
+    def test_rejects_one_off_entries(self):
+        """should keep hot entries when a scan of new keys is written"""
+        self.store.configure(max_entries=2, policy=TinyLFUPolicy())
+        self.store.write('hot1', 1)
+        self.store.write('hot2', 2)
+        for i in range(5):
+            self.store.read('hot1')
+            self.store.read('hot2')
+        for i in range(10):
+            self.store.write('scan%d' % i, i)
+        self.assertEqual(set(self.store.store.keys()),
+                set(['hot1', 'hot2']))
+
+    def test_admits_frequent_entries(self):
+        """should admit an entry requested more often than the victim"""
+        self.store.configure(max_entries=1, policy=TinyLFUPolicy())
+        self.store.write('old', 1)
+        for i in range(3):
+            self.store.read('new')
+        self.store.write('new', 2)
+        self.assertEqual(self.store.store.keys(), ['new'])
+
+    def test_aging(self):
+        """should halve frequencies after sample_size accesses"""
+        policy = TinyLFUPolicy(width=16, sample_size=4)
+        for i in range(3):
+            policy.record('foo')
+        self.assertEqual(policy.frequency('foo'), 3)
+        policy.record('foo')
+        self.assertEqual(policy.frequency('foo'), 2)
+
+
+class CacheStoreThreadSafetyTestCase(CacheStoreBaseTestCase):
+
+    def test_concurrent_writes(self):
+        """should keep its bookkeeping consistent across threads"""
+        self.store.configure(max_entries=50, max_bytes=100000)
+        def work(n):
+            for i in range(200):
+                key = '%d-%d' % (n, i % 70)
+                self.store.write(key, 'x' * i, tags=[n])
+                self.store.read(key)
+                if i % 50 == 0:
+                    self.store.invalidate(n)
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(len(self.store.store) <= 50)
+        self.assertEqual(self.store.bytes, sum(self.store.sizes.values()))
+        self.assertEqual(set(self.store.sizes.keys()),
+                set(self.store.store.keys()))
+
+
+class CacheStoreInvalidateMethodTestCase(CacheStoreBaseTestCase):
+
+    def test_invalidate_tag(self):
+        """should remove only the entries with the given tags"""
+        self.store.write('foo', 1, tags=['a'])
+        self.store.write('bar', 2, tags=['a', 'b'])
+        self.store.write('baz', 3, tags=['c'])
+        self.store.invalidate('b')
+        self.assertEqual(set(self.store.store.keys()), set(['foo', 'baz']))
+        self.store.invalidate('a', 'c')
+        self.assertEqual(len(self.store.store), 0)
+        self.assertEqual(self.store.tags, {})
+
+    def test_untags_removed_entries(self):
+        """should forget tags when an entry is removed"""
+        self.store.write('foo', 1, tags=['a'])
+        self.store.clear('foo')
+        self.assertEqual(self.store.tags, {})
+        self.assertEqual(self.store.entry_tags, {})
+
+
 class LocalCacheRegistersToCaching(unittest.TestCase):
 
     def test_caching(self):
@@ -191,3 +858,7 @@ class LocalCacheRegistersToCaching(unittest.TestCase):
                 in
                 caching.registry)
 
+    def test_invalidator(self):
+        store = pyperry.middlewares.local_cache.cache_store
+        self.assertEqual(caching.invalidators[store.empty], store.invalidate)
+
@@ -78,6 +78,26 @@ class ModelBridgeReadTestCase(ModelBridgeBaseTestCase):
         result = self.bridge(**self.stack_opts)
         self.assertEqual(result[0].new_record, False)
 
+    def test_raw(self):
+        """should return the raw records for raw reads"""
+        self.adapter.return_value = [None, {'id': 1}]
+        result = self.bridge(raw=True, **self.stack_opts)
+        self.assertEqual(result, [{'id': 1}])
+
+    def test_stream(self):
+        """should instantiate streamed records as they are iterated"""
+        reached = []
+        def records():
+            for i in [1, None, 2]:
+                reached.append(i)
+                yield i and { 'id': i }
+        self.adapter.return_value = records()
+        result = self.bridge(stream=True, **self.stack_opts)
+        self.assertEqual(reached, [])
+        self.assertEqual(result.next().id, 1)
+        self.assertEqual(reached, [1])
+        self.assertEqual([r.id for r in result], [2])
+
 
 class BridgeTest(Test):
     id = Field()
@@ -108,6 +128,37 @@ class ModelBridgeWriteTestCase(ModelBridgeBaseTestCase):
         ModelBridge(SuccessAdapter())(**self.options)
         self.assertEqual(self.called_foo, True)
 
+    def test_invalidates_model_class(self):
+        """should only invalidate caches for the written model's class"""
+        self.invalidated = None
+        def foo(*klasses):
+            self.invalidated = klasses
+        def reset():
+            self.invalidated = 'reset'
+
+        caching.register(reset, foo)
+        try:
+            ModelBridge(SuccessAdapter())(**self.options)
+            self.assertEqual(self.invalidated, (self.model_class,))
+            self.options['mode'] = 'delete'
+            ModelBridge(SuccessAdapter())(**self.options)
+            self.assertEqual(self.invalidated, (self.model_class,))
+        finally:
+            caching.registry.remove(reset)
+
+    def test_batch_write_resets_caching(self):
+        """should reset all caches on writes without a model"""
+        self.called_foo = False
+        def foo():
+            self.called_foo = True
+
+        caching.register(foo, lambda *klasses: None)
+        try:
+            ModelBridge(SuccessAdapter())(mode='write', where=[], fields={})
+            self.assertEqual(self.called_foo, True)
+        finally:
+            caching.registry.remove(foo)
+
 
 class WriteExistingRecordsTestCase(ModelBridgeWriteTestCase):
 
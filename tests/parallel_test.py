@@ -0,0 +1,56 @@
+import tests
+import unittest
+import threading
+import time
+
+from pyperry import identity_map
+from pyperry.parallel import pmap
+
+class PmapTestCase(unittest.TestCase):
+
+    def test_results_in_order(self):
+        """should return the results in the order of the items"""
+        def slow_double(x):
+            time.sleep(0.01 * (5 - x))
+            return x * 2
+        self.assertEqual(pmap(slow_double, range(5), 3), [0, 2, 4, 6, 8])
+
+    def test_bounded_workers(self):
+        """should run at most the given number of calls at once"""
+        running = [0]
+        peak = [0]
+        lock = threading.Lock()
+        def call(x):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+        pmap(call, range(10), 3)
+        self.assertTrue(1 < peak[0] <= 3)
+
+    def test_single_worker(self):
+        """should run the calls in the current thread with one worker"""
+        threads = pmap(lambda x: threading.current_thread(), range(3), 1)
+        self.assertEqual(set(threads), set([threading.current_thread()]))
+
+    def test_raises_first_error(self):
+        """should raise the error of the first failing item"""
+        def call(x):
+            if x > 1:
+                raise ValueError(x)
+        try:
+            pmap(call, range(5), 4)
+        except ValueError, err:
+            self.assertEqual(err.args, (2,))
+        else:
+            self.fail('no error raised')
+
+    def test_joins_identity_scope(self):
+        """should run the calls in the caller's identity scope"""
+        with identity_map.identity_scope() as identities:
+            maps = pmap(lambda x: identity_map.current(), range(3), 3)
+        self.assertEqual(maps, [identities] * 3)
+        self.assertEqual(pmap(lambda x: identity_map.current(), range(2), 2),
+                [None, None])
@@ -1,14 +1,20 @@
 import tests
 import unittest
+import threading
+import time
 from nose.plugins.skip import SkipTest
 
 import pyperry
 from pyperry.errors import AssociationNotFound, AssociationPreloadNotSupported
 from pyperry.processors.preload_associations import PreloadAssociations
+from pyperry.processors import preload_associations
 from pyperry.field import Field
+from pyperry.association import HasMany, BelongsTo
+from pyperry.scope import DefaultScope
 
 from tests.fixtures.test_adapter import PreloadTestAdapter, TestAdapter
 from tests.fixtures.association_models import Site, Article, Comment, Person
+from tests.fixtures.association_models import AssocTest
 
 class PreloadAssociationsProcessorTestCase(unittest.TestCase):
 
@@ -59,6 +65,29 @@ class PreloadAssociationsProcessorTestCase(unittest.TestCase):
         Site.includes('articles', 'comments', 'maintainer').all()
         self.assertEqual(len(self.adapter.calls), 4)
 
+    def test_skip_raw_reads(self):
+        """should not preload raw reads"""
+        values = Site.includes('articles', 'maintainer').pluck('id')
+        self.assertEqual(values, [1, 2, 3, 4, 5])
+        self.assertEqual(len(self.adapter.calls), 1)
+
+    def test_chunked_preload(self):
+        """should load associations for chunks of find_chunk_size results"""
+        Site.find_chunk_size = 2
+        try:
+            sites = Site.includes('maintainer', 'articles').all()
+        finally:
+            del Site.find_chunk_size
+
+        self.assertEqual(len(self.adapter.calls), 7)
+        maintainers = [call for call in self.adapter.calls
+                       if call.klass is Person]
+        self.assertEqual([call.query()['where'] for call in maintainers],
+                [[{'id': [100]}]] * 3)
+        for site in sites:
+            self.assertEqual(site.maintainer.id, 100)
+            self.assertEqual(len(site.articles), 1 if site.id == 1 else 0)
+
     def test_include_results(self):
         """should include the preload results on the relation"""
         rel = Site.includes('articles', 'comments', 'maintainer', 'headline')
@@ -67,12 +96,12 @@ class PreloadAssociationsProcessorTestCase(unittest.TestCase):
         call_count = len(self.adapter.calls)
 
         # has_many
-        self.assertEqual(type(site.articles), pyperry.Relation)
+        self.assertTrue(isinstance(site.articles, pyperry.Relation))
         for article in site.articles:
             self.assertEqual(type(article), Article)
 
         # has_many polymorphic
-        self.assertEqual(type(site.comments), pyperry.Relation)
+        self.assertTrue(isinstance(site.comments, pyperry.Relation))
         for comment in site.comments:
             self.assertEqual(type(comment), Comment)
 
@@ -133,6 +162,62 @@ class PreloadAssociationsProcessorTestCase(unittest.TestCase):
         self.assertEqual(site.articles.query(), article_relation.query())
         self.assertEqual(site.comments.query(), comment_relation.query())
 
+    def test_lazy_scopes(self):
+        """should only build the association scope when it is chained on"""
+        sites = Site.includes('articles').all()
+        articles = sites[1].articles
+        self.assertEqual(articles._params, None)
+        self.assertEqual(list(articles), [])
+        self.assertEqual(articles._params, None)
+
+        scope = Site.defined_associations['articles'].scope(sites[1])
+        chained = articles.where('foo')
+        self.assertEqual(type(chained), pyperry.Relation)
+        self.assertEqual(chained.query(), scope.where('foo').query())
+
+    def test_sequential_siblings(self):
+        """should load sibling associations one after another by default"""
+        threads = set()
+        class ThreadAdapter(PreloadTestAdapter):
+            def read(self, **kwargs):
+                threads.add(threading.current_thread())
+                return super(ThreadAdapter, self).read(**kwargs)
+        for klass in self.MODELS:
+            klass.reader = ThreadAdapter(
+                    processors=[(PreloadAssociations, {})])
+
+        Site.includes('articles', 'comments', 'maintainer').all()
+        self.assertEqual(threads, set([threading.current_thread()]))
+
+    def test_concurrent_siblings(self):
+        """should load sibling associations concurrently if configured"""
+        arrived = []
+        overlapped = []
+        condition = threading.Condition()
+        class WaitingAdapter(PreloadTestAdapter):
+            def read(self, **kwargs):
+                if kwargs['relation'].klass is not Site:
+                    # Each sibling read waits for the other two to start
+                    with condition:
+                        arrived.append(kwargs['relation'].klass)
+                        condition.notify_all()
+                        deadline = time.time() + 5
+                        while len(arrived) < 3 and time.time() < deadline:
+                            condition.wait(deadline - time.time())
+                        overlapped.append(len(arrived) == 3)
+                return super(WaitingAdapter, self).read(**kwargs)
+        for klass in self.MODELS:
+            klass.reader = WaitingAdapter(
+                    processors=[(PreloadAssociations, {})])
+
+        Site.preload_workers = 4
+        try:
+            site = Site.includes('articles', 'comments', 'maintainer').all()[0]
+        finally:
+            del Site.preload_workers
+        self.assertEqual(overlapped, [True, True, True])
+        self.assertEqual(site.maintainer.id, 100)
+
     def test_nested_includes(self):
         """should nest includes queries using a tree like syntax"""
         data = self.data(5)
@@ -162,3 +247,318 @@ class PreloadAssociationsProcessorTestCase(unittest.TestCase):
         """
         self.assertRaises(AssociationPreloadNotSupported,
                           Site.includes('fun_articles').all)
+
+
+class RecordsAdapter(TestAdapter):
+    """Adapter returning the rows of a class that match dict conditions"""
+
+    rows = {}
+
+    def read(self, **kwargs):
+        rel = kwargs['relation']
+        self.calls.append(rel)
+        rows = self.rows[rel.klass.__name__]
+        for condition in rel.query().get('where', []):
+            for attr, value in condition.items():
+                values = value if isinstance(value, list) else [value]
+                rows = [row for row in rows if row.get(attr) in values]
+        return rows
+
+
+class RecordsAdapterTestCase(unittest.TestCase):
+
+    MODELS = [Site, Article, Comment, Person]
+
+    def setUp(self):
+        TestAdapter.reset_calls()
+        for klass in self.MODELS:
+            klass.reader = RecordsAdapter(
+                    processors=[(PreloadAssociations, {})])
+        RecordsAdapter.rows = {
+            'Site': [{'id': 1}, {'id': 2}, {'id': 3}],
+            'Article': [{'id': 10, 'site_id': 1}, {'id': 11, 'site_id': 1},
+                        {'id': 12, 'site_id': 2}],
+            'Comment': [
+                {'id': 20, 'parent_id': 10, 'parent_type': 'Article',
+                 'person_id': 30},
+                {'id': 21, 'parent_id': 12, 'parent_type': 'Article',
+                 'person_id': 30},
+                {'id': 22, 'parent_id': 11, 'parent_type': 'Article',
+                 'person_id': 31},
+                {'id': 23, 'parent_id': 1, 'parent_type': 'Site',
+                 'person_id': 30}],
+            'Person': [{'id': 30}, {'id': 31}],
+        }
+
+    def tearDown(self):
+        TestAdapter.reset_calls()
+        for klass in self.MODELS:
+            klass.reader = TestAdapter()
+
+
+class PreloadHasManyThroughTestCase(RecordsAdapterTestCase):
+
+    def test_has_many_through(self):
+        """should preload through the proxy records in two queries"""
+        sites = Site.includes('article_comments').all()
+        self.assertEqual(len(TestAdapter.calls), 3)
+        self.assertEqual([[c.id for c in site.article_comments]
+                          for site in sites], [[20, 22], [21], []])
+        self.assertEqual(len(TestAdapter.calls), 3)
+
+    def test_polymorphic_source(self):
+        """should limit polymorphic has source records to the proxy class"""
+        Site.includes('article_comments').all()
+        self.assertEqual(TestAdapter.calls[-1].query()['where'],
+                [{'parent_type': 'Article'}, {'parent_id': [10, 11, 12]}])
+
+    def test_nested_includes(self):
+        """should preload includes nested under the source records"""
+        sites = Site.includes({'article_comments': 'author'}).all()
+        self.assertEqual(len(TestAdapter.calls), 4)
+        authors = [c.author.id for c in sites[0].article_comments]
+        self.assertEqual(authors, [30, 31])
+        self.assertEqual(len(TestAdapter.calls), 4)
+
+
+class PreloadPolymorphicBelongsToTestCase(RecordsAdapterTestCase):
+
+    def setUp(self):
+        super(PreloadPolymorphicBelongsToTestCase, self).setUp()
+        RecordsAdapter.rows['Comment'] = [
+            {'id': 20, 'parent_id': 1, 'parent_type': 'Site'},
+            {'id': 21, 'parent_id': 20, 'parent_type': 'Comment'},
+            {'id': 22, 'parent_id': 2, 'parent_type': 'Site'},
+            {'id': 23, 'parent_id': 1, 'parent_type': 'Site'},
+            {'id': 24, 'parent_id': 99, 'parent_type': 'Site'},
+            {'id': 25, 'parent_id': None, 'parent_type': None}]
+
+    def test_polymorphic_belongs_to(self):
+        """should load each parent type with one query"""
+        comments = Comment.where({'id': [20, 21, 22, 23, 24, 25]}).includes(
+                'parent').all()
+        self.assertEqual(len(TestAdapter.calls), 3)
+        parents = [(c.parent.__class__.__name__, c.parent.id)
+                   if c.parent else None for c in comments]
+        self.assertEqual(parents, [('Site', 1), ('Comment', 20),
+                ('Site', 2), ('Site', 1), None, None])
+        self.assertEqual(len(TestAdapter.calls), 3)
+
+        site_call = [call for call in TestAdapter.calls[1:]
+                     if call.klass is Site][0]
+        self.assertEqual(site_call.query()['where'],
+                [{'id': [1, 2, 99]}])
+
+    def test_shared_parents(self):
+        """should share one record between parents of the same key"""
+        comments = Comment.includes('parent').all()
+        self.assertTrue(comments[0].parent is comments[3].parent)
+
+
+class DynamicSite(AssocTest):
+    id = Field()
+    articles = HasMany(class_name='Article', foreign_key='site_id',
+            namespace='tests.fixtures.association_models',
+            where=lambda: {'site_id': [1, 2]})
+    auto_preload = True
+
+
+tenant = threading.local()
+
+class TenantPerson(AssocTest):
+    id = Field()
+    tenant_id = Field()
+    _default = DefaultScope(where=lambda: {
+            'tenant_id': getattr(tenant, 'id', None) })
+
+
+class TenantSite(AssocTest):
+    id = Field()
+    maintainer_id = Field()
+    maintainer = BelongsTo(klass=lambda: TenantPerson)
+    find_chunk_size = 2
+    find_workers = 4
+
+
+class PreloadThreadLocalScopeTestCase(RecordsAdapterTestCase):
+
+    MODELS = [TenantSite, TenantPerson]
+
+    def setUp(self):
+        super(PreloadThreadLocalScopeTestCase, self).setUp()
+        RecordsAdapter.rows = {
+            'TenantSite': [{'id': i, 'maintainer_id': 30 + i}
+                           for i in range(5)],
+            'TenantPerson': [{'id': 30 + i, 'tenant_id': 7}
+                             for i in range(5)],
+        }
+        tenant.id = 7
+
+    def tearDown(self):
+        super(PreloadThreadLocalScopeTestCase, self).tearDown()
+        del tenant.id
+
+    def test_chunk_queries(self):
+        """should build chunk queries with the caller's thread locals"""
+        sites = TenantSite.includes('maintainer').all()
+        people = [call for call in TestAdapter.calls
+                  if call.klass is TenantPerson]
+        self.assertEqual(len(people), 3)
+        for call in people:
+            self.assertTrue({'tenant_id': 7} in call.query()['where'])
+        self.assertEqual([site.maintainer.id for site in sites],
+                         [30, 31, 32, 33, 34])
+
+    def test_fetch_in(self):
+        """should fetch key chunks with the caller's thread locals"""
+        TenantPerson.find_chunk_size = 2
+        TenantPerson.find_workers = 4
+        try:
+            people = TenantPerson.find([30, 31, 32, 33, 34])
+        finally:
+            del TenantPerson.find_chunk_size
+            del TenantPerson.find_workers
+        self.assertEqual([person.id for person in people],
+                         [30, 31, 32, 33, 34])
+        self.assertEqual(len(TestAdapter.calls), 3)
+
+
+class AutoPreloadTestCase(RecordsAdapterTestCase):
+
+    MODELS = RecordsAdapterTestCase.MODELS + [DynamicSite]
+
+    def setUp(self):
+        super(AutoPreloadTestCase, self).setUp()
+        RecordsAdapter.rows['DynamicSite'] = RecordsAdapter.rows['Site']
+        Site.auto_preload = True
+
+    def tearDown(self):
+        super(AutoPreloadTestCase, self).tearDown()
+        del Site.auto_preload
+        pyperry.auto_preload.detect(None)
+
+    def test_belongs_to(self):
+        """should load a belongs_to for every sibling on first access"""
+        Article.auto_preload = True
+        try:
+            articles = Article.all()
+            self.assertEqual([a.site.id for a in articles], [1, 1, 2])
+            self.assertEqual(len(TestAdapter.calls), 2)
+        finally:
+            del Article.auto_preload
+
+    def test_has_many(self):
+        """should load a has_many for every sibling on first access"""
+        sites = Site.all()
+        self.assertEqual([[a.id for a in site.articles] for site in sites],
+                         [[10, 11], [12], []])
+        self.assertEqual(len(TestAdapter.calls), 2)
+
+    def test_disabled(self):
+        """should load each record's association separately by default"""
+        del Site.auto_preload
+        try:
+            sites = Site.all()
+            [list(site.articles) for site in sites]
+            self.assertEqual(len(TestAdapter.calls), 4)
+        finally:
+            Site.auto_preload = True
+
+    def test_not_eager_loadable(self):
+        """should fall back to lazy loading associations with callables"""
+        sites = DynamicSite.all()
+        self.assertEqual([[a.id for a in site.articles] for site in sites],
+                         [[10, 11], [12], []])
+        self.assertEqual(len(TestAdapter.calls), 4)
+
+    def test_not_eager_loadable_attempts(self):
+        """should not try to preload associations with callables"""
+        calls = []
+        preload = preload_associations.preload
+        preload_associations.preload = lambda *args: calls.append(args)
+        try:
+            [list(site.articles) for site in DynamicSite.all()]
+        finally:
+            preload_associations.preload = preload
+        self.assertEqual(calls, [])
+
+    def test_unsupported_attempted_once(self):
+        """should only try once to preload an unsupported association"""
+        calls = []
+        def preload(*args):
+            calls.append(args)
+            raise AssociationPreloadNotSupported()
+        original = preload_associations.preload
+        preload_associations.preload = preload
+        try:
+            [list(site.articles) for site in Site.all()]
+        finally:
+            preload_associations.preload = original
+        self.assertEqual(len(calls), 1)
+
+    def test_single_record(self):
+        """should not track siblings of a lone record"""
+        site = Site.where({'id': 1}).first()
+        self.assertFalse(hasattr(site, '_siblings'))
+
+    def test_detector_raises(self):
+        """should raise once lazy loads of siblings pass the threshold"""
+        del Site.auto_preload
+        pyperry.auto_preload.detect(threshold=1, raise_error=True)
+        try:
+            sites = Site.all()
+            list(sites[0].articles)
+            self.assertRaises(pyperry.errors.NPlusOneQuery,
+                              lambda: sites[1].articles)
+        finally:
+            Site.auto_preload = True
+
+    def test_detector_ignores_preloads(self):
+        """should not count loads avoided by auto_preload"""
+        pyperry.auto_preload.detect(threshold=0, raise_error=True)
+        sites = Site.all()
+        [list(site.articles) for site in sites]
+        self.assertEqual(len(TestAdapter.calls), 2)
+
+
+class PreloadFunctionTestCase(RecordsAdapterTestCase):
+
+    def test_loaded_records(self):
+        """should preload associations onto records already loaded"""
+        articles = Article.all()
+        self.assertTrue(pyperry.preload(articles, 'site') is articles)
+        self.assertEqual(len(TestAdapter.calls), 2)
+        self.assertEqual([a.site.id for a in articles], [1, 1, 2])
+        self.assertEqual(len(TestAdapter.calls), 2)
+
+    def test_nested_includes(self):
+        """should preload nested includes"""
+        articles = Article.all()
+        pyperry.preload(articles, {'comments': 'author'})
+        self.assertEqual(len(TestAdapter.calls), 3)
+        self.assertEqual([[c.author.id for c in a.comments]
+                          for a in articles], [[30], [31], [30]])
+        self.assertEqual(len(TestAdapter.calls), 3)
+
+    def test_mixed_classes(self):
+        """should preload the records of each class together"""
+        records = Site.all() + Article.all() + [None]
+        pyperry.preload(records, 'comments')
+        self.assertEqual(len(TestAdapter.calls), 4)
+        self.assertEqual([[c.id for c in r.comments] for r in records[:-1]],
+                         [[23], [], [], [20], [22], [21]])
+        self.assertEqual(len(TestAdapter.calls), 4)
+
+    def test_repeated_records(self):
+        """should send the keys of repeated records once"""
+        articles = Article.all()
+        pyperry.preload(articles + articles, 'comments')
+        self.assertEqual(TestAdapter.calls[-1].query()['where'][0],
+                         {'parent_id': [10, 11, 12]})
+        self.assertEqual([[c.id for c in a.comments] for a in articles],
+                         [[20], [22], [21]])
+
+    def test_unknown_association(self):
+        """should raise AssociationNotFound for unknown associations"""
+        self.assertRaises(AssociationNotFound, pyperry.preload,
+                          Article.all(), 'foo')
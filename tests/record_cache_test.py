@@ -0,0 +1,129 @@
+import tests
+import unittest
+
+import pyperry
+from pyperry import caching
+from pyperry import record_cache
+from pyperry.field import Field
+from pyperry.association import BelongsTo
+from pyperry.errors import RecordNotFound
+from tests.fixtures.test_adapter import TestAdapter
+
+class RecordAdapter(TestAdapter):
+    """Returns the records in data matching the queried primary keys"""
+
+    def read(self, **kwargs):
+        query = kwargs['relation'].query()
+        self.calls.append(query)
+        keys = None
+        for condition in query.get('where', []):
+            if isinstance(condition, dict) and 'id' in condition:
+                keys = condition['id']
+                if not isinstance(keys, list):
+                    keys = [keys]
+        return [record for record in self.data
+                if keys is None or record['id'] in keys]
+
+
+class RecordCacheBaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class Person(pyperry.Base):
+            id = Field()
+            name = Field()
+            record_cache_interval = 60
+            reader = RecordAdapter()
+
+        class Post(pyperry.Base):
+            id = Field()
+            person_id = Field()
+            person = BelongsTo(klass=Person)
+            reader = RecordAdapter()
+
+        self.Person = Person
+        self.Post = Post
+        RecordAdapter.data = [{ 'id': i, 'name': 'p%d' % i }
+                              for i in range(1, 6)]
+
+    def tearDown(self):
+        record_cache.store.empty()
+        RecordAdapter.reset_calls()
+
+
+class RecordCacheFillTestCase(RecordCacheBaseTestCase):
+
+    def test_fills_from_reads(self):
+        """should cache every record read for the model"""
+        self.Person.all()
+        self.assertEqual(len(record_cache.store.store), 5)
+        self.assertEqual(record_cache.store.read((self.Person, 3)),
+                { 'id': 3, 'name': 'p3' })
+
+    def test_disabled(self):
+        """should not cache models without a record_cache_interval"""
+        RecordAdapter.data = [{ 'id': 1, 'person_id': 1 }]
+        self.Post.all()
+        self.assertEqual(len(record_cache.store.store), 0)
+
+    def test_skips_select(self):
+        """should not cache partial records"""
+        self.Person.select('id').all()
+        self.assertEqual(len(record_cache.store.store), 0)
+
+    def test_invalidated_by_writes(self):
+        self.Person.all()
+        caching.invalidate(self.Person)
+        self.assertEqual(len(record_cache.store.store), 0)
+
+
+class RecordCacheFindTestCase(RecordCacheBaseTestCase):
+
+    def test_find_cached(self):
+        """should answer find(pk) without an adapter call"""
+        self.Person.all()
+        calls = len(RecordAdapter.calls)
+        person = self.Person.find(2)
+        self.assertEqual(person.fields, { 'id': 2, 'name': 'p2' })
+        self.assertEqual(person.new_record, False)
+        self.assertEqual(len(RecordAdapter.calls), calls)
+
+    def test_find_list_partial(self):
+        """should only fetch the keys missing from the cache"""
+        self.Person.find([1, 2])
+        people = self.Person.find([3, 2, 1, 4])
+        self.assertEqual([p.id for p in people], [3, 2, 1, 4])
+        self.assertEqual(RecordAdapter.calls[-1],
+                { 'where': [{ 'id': [3, 4] }] })
+
+    def test_find_missing(self):
+        """should still raise when records are missing"""
+        self.assertRaises(RecordNotFound, self.Person.find, 10)
+        self.assertRaises(RecordNotFound, self.Person.find, [1, 10])
+
+    def test_other_conditions(self):
+        """should use the adapter for queries with other conditions"""
+        self.Person.all()
+        calls = len(RecordAdapter.calls)
+        self.Person.where('name = "p2"').find(2)
+        self.Person.where({ 'id': 2 }).fresh().first()
+        self.assertEqual(len(RecordAdapter.calls), calls + 2)
+
+    def test_belongs_to(self):
+        """should load belongs_to associations from the cache"""
+        self.Person.all()
+        calls = len(RecordAdapter.calls)
+        post = self.Post({ 'id': 1, 'person_id': 4 }, False)
+        self.assertEqual(post.person.name, 'p4')
+        self.assertEqual(len(RecordAdapter.calls), calls)
+
+    def test_new_instances(self):
+        """should not share instances between lookups"""
+        self.Person.all()
+        person = self.Person.find(1)
+        person.name = 'changed'
+        self.assertEqual(self.Person.find(1).name, 'p1')
+
+    def test_identity_scope(self):
+        self.Person.all()
+        with pyperry.identity_scope():
+            self.assertTrue(self.Person.find(1) is self.Person.find(1))
@@ -8,8 +8,10 @@ from pyperry.field import Field
 from pyperry.scope import Scope
 
 from fixtures.test_adapter import TestAdapter
+from pyperry.processors.preload_associations import PreloadAssociations
 
 Relation = pyperry.Relation
+from pyperry.relation import QueryValues
 #
 #
 # Relation
@@ -100,6 +102,24 @@ class CloneTestCase(BaseRelationTestCase):
         rel = self.relation.where(id=re.compile('foo'))
         rel.clone()
 
+    def test_shares_values(self):
+        """should share query values with the cloned relation"""
+        rel = self.relation.where('foo').where('bar')
+        cloned = rel.clone()
+        self.assertTrue(cloned.params['where'] is rel.params['where'])
+        self.assertTrue(rel.where('baz').params['where'].parent is
+                rel.params['where'])
+
+    def test_hashable(self):
+        """should hash and compare equal to relations with the same query"""
+        rel1 = self.relation.where(id=1).order('name')
+        rel2 = self.relation.where(id=1).order('name')
+        rel3 = self.relation.where(id=2).order('name')
+        self.assertEqual(rel1, rel2)
+        self.assertEqual(hash(rel1), hash(rel2))
+        self.assertNotEqual(rel1, rel3)
+        self.assertEqual(len(set([rel1, rel2, rel3])), 2)
+
     def test_clones_on_selfs_class(self):
         class MyRelation(Relation): pass
         rel = MyRelation(self.Test)
@@ -129,6 +149,49 @@ class RequestDictTestCase(BaseRelationTestCase):
 
         self.assertEqual(query, { 'where': ['foo'], 'limit': 1 })
 
+    def test_shared_plan(self):
+        """should reuse the compiled plan for relations with the same query"""
+        rel1 = self.relation.where(id=1).includes('foo')
+        rel2 = self.relation.where(id=1).includes('foo')
+        rel1.query()
+        plans = len(Relation.query_plans)
+        self.assertEqual(rel1.query(), rel2.query())
+        self.assertEqual(len(Relation.query_plans), plans)
+
+    def test_plan_values_copied(self):
+        """should not leak changes to one query into another"""
+        query = self.relation.where({'a': 1}).includes('foo').query()
+        query['where'].append('bar')
+        query['includes']['baz'] = {}
+        self.assertEqual(self.relation.where({'a': 1}).includes(
+                'foo').query(), { 'where': [{'a': 1}],
+                                  'includes': { 'foo': {} } })
+
+    def test_plan_evaluates_lambdas(self):
+        """should evaluate lambdas each time a query is built"""
+        counter = [0]
+        def next_id():
+            counter[0] += 1
+            return counter[0]
+        rel = self.relation.where('foo').limit(next_id)
+        self.assertEqual(rel.query(), { 'where': ['foo'], 'limit': 1 })
+        self.assertEqual(rel.clone().query(),
+                { 'where': ['foo'], 'limit': 2 })
+        self.assertEqual(self.relation.where('foo').limit(
+                lambda: 5).query(), { 'where': ['foo'], 'limit': 5 })
+
+    def test_plan_distinguishes_types(self):
+        """should not share plans between values of different types"""
+        self.assertEqual(self.relation.limit(1).query()['limit'], 1)
+        self.assertTrue(self.relation.limit(True).query()['limit'] is True)
+
+    def test_unhashable_values(self):
+        """should build queries with values that can't be hashed"""
+        class Unhashable(object):
+            __hash__ = None
+        value = Unhashable()
+        self.assertTrue(self.relation.limit(value).query()['limit'] is value)
+
 
 ##
 # Test fetching records through the base class and returning the results
@@ -410,6 +473,97 @@ class MergeRelationTestCase(BaseRelationTestCase):
         self.assertEqual(merged.params['group'], ['baz'])
         self.assertEqual(merged.params['select'], ['poop'])
 
+    def test_modifiers(self):
+        """should combine the modifiers of both relations"""
+        new_relation = Relation(self.Test).modifiers({'a': 1}).modifiers(
+                {'b': 2})
+        merged = self.relation.modifiers({'c': 3}).merge(new_relation)
+        self.assertEqual(merged.modifiers_value(), {'a': 1, 'b': 2, 'c': 3})
+
+##
+# Test the immutable plural query values
+#
+class QueryValuesTestCase(unittest.TestCase):
+
+    def test_extend(self):
+        """should return a new instance without changing the original"""
+        values = QueryValues(['foo'])
+        extended = values.extend(['bar', 'baz'])
+        self.assertEqual(values, ['foo'])
+        self.assertEqual(extended, ['foo', 'bar', 'baz'])
+        self.assertEqual(len(extended), 3)
+        self.assertEqual(extended[1], 'bar')
+        self.assertEqual(extended[1:], ['bar', 'baz'])
+
+    def test_add(self):
+        """should support adding lists on either side"""
+        values = QueryValues(['foo'])
+        self.assertEqual(values + ['bar'], ['foo', 'bar'])
+        self.assertEqual(['bar'] + values, ['bar', 'foo'])
+        self.assertTrue(isinstance(['bar'] + values, QueryValues))
+
+    def test_extend_empty(self):
+        """should reuse instances when there is nothing to share"""
+        values = QueryValues(['foo'])
+        self.assertTrue(values.extend([]) is values)
+        self.assertTrue(QueryValues().extend(['foo']).parent is None)
+
+    def test_repr(self):
+        """should repr like a list"""
+        self.assertEqual(repr(QueryValues(['foo'])), "['foo']")
+
+##
+# Test the canonical query fingerprint
+#
+class FingerprintTestCase(BaseRelationTestCase):
+
+    def test_stable(self):
+        """should return the same digest for equal relations"""
+        rel1 = self.relation.where({'id': 1, 'name': 'foo'}).limit(2)
+        rel2 = self.relation.limit(2).where({'name': 'foo', 'id': 1})
+        self.assertEqual(rel1.fingerprint(), rel2.fingerprint())
+
+    def test_where_order_independent(self):
+        """should not depend on the order of chained where calls"""
+        rel1 = self.relation.where('foo').where({'id': [1, 2]})
+        rel2 = self.relation.where({'id': [1, 2]}).where('foo')
+        self.assertEqual(rel1.fingerprint(), rel2.fingerprint())
+
+    def test_order_dependent(self):
+        """should depend on the order of order values"""
+        rel1 = self.relation.order('foo', 'bar')
+        rel2 = self.relation.order('bar', 'foo')
+        self.assertNotEqual(rel1.fingerprint(), rel2.fingerprint())
+
+    def test_differs_by_value(self):
+        rel1 = self.relation.where({'id': [1, 2]})
+        rel2 = self.relation.where({'id': [2, 1]})
+        self.assertNotEqual(rel1.fingerprint(), rel2.fingerprint())
+
+    def test_differs_by_class(self):
+        class Other(pyperry.Base):
+            id = Field()
+        rel = Relation(Other).where('foo')
+        self.assertNotEqual(rel.fingerprint(),
+                self.relation.where('foo').fingerprint())
+
+    def test_regular_expressions(self):
+        """should normalize compiled regular expressions"""
+        rel1 = self.relation.where(name=re.compile('foo', re.I))
+        rel2 = self.relation.where(name=re.compile('foo', re.I))
+        rel3 = self.relation.where(name=re.compile('foo'))
+        self.assertEqual(rel1.fingerprint(), rel2.fingerprint())
+        self.assertNotEqual(rel1.fingerprint(), rel3.fingerprint())
+
+    def test_memoized(self):
+        """should memoize the fingerprint until reset"""
+        rel = self.relation.where('foo')
+        fingerprint = rel.fingerprint()
+        rel.params['where'] += ['bar']
+        self.assertEqual(rel.fingerprint(), fingerprint)
+        rel.reset()
+        self.assertNotEqual(rel.fingerprint(), fingerprint)
+
 ##
 # Test that modifiers behaves almost like a query method
 #
@@ -619,6 +773,274 @@ class RelationAllMethodTestCase(BaseRelationTestCase):
         self.assertEqual(TestAdapter.calls[-1], { 'where': ['bar', 'foo']})
 
 
+##
+# Batched iteration
+#
+class PagingAdapter(TestAdapter):
+    """Adapter serving rows that honors pk conditions, order and limits"""
+
+    def __init__(self, *args, **kwargs):
+        super(PagingAdapter, self).__init__(*args, **kwargs)
+        self.features['keyset'] = True
+
+    def read(self, **kwargs):
+        query = kwargs['relation'].query()
+        self.calls.append(query)
+        rows = [{ 'id': i } for i in range(1, 8)]
+        for condition in query.get('where', []):
+            op, value = condition.split()[1:]
+            if op == '>':
+                rows = [r for r in rows if r['id'] > int(value)]
+            else:
+                rows = [r for r in rows if r['id'] < int(value)]
+        if query.get('order') == ['id DESC']:
+            rows.reverse()
+        offset = query.get('offset') or 0
+        return rows[offset:offset + query.get('limit', len(rows))]
+
+
+class RelationFindInBatchesTestCase(BaseRelationTestCase):
+
+    def setUp(self):
+        super(RelationFindInBatchesTestCase, self).setUp()
+        self.Test.reader = PagingAdapter()
+
+    def ids(self, batches):
+        return [[r.id for r in batch] for batch in batches]
+
+    def test_keyset_pagination(self):
+        """should page through records on the primary key"""
+        batches = self.relation.find_in_batches(batch_size=3)
+        self.assertEqual(self.ids(batches), [[1, 2, 3], [4, 5, 6], [7]])
+        self.assertEqual(TestAdapter.calls, [
+            { 'order': ['id'], 'limit': 3 },
+            { 'order': ['id'], 'limit': 3, 'where': ['id > 3'] },
+            { 'order': ['id'], 'limit': 3, 'where': ['id > 6'] }])
+
+    def test_keyset_pagination_descending(self):
+        """should keep a descending primary key order"""
+        batches = self.relation.order('id DESC').find_in_batches(3)
+        self.assertEqual(self.ids(batches), [[7, 6, 5], [4, 3, 2], [1]])
+        self.assertEqual(TestAdapter.calls[-1]['where'], ['id < 2'])
+
+    def test_offset_pagination_by_default(self):
+        """should page with limit and offset unless keyset is supported"""
+        self.Test.reader.features['keyset'] = False
+        batches = self.relation.find_in_batches(batch_size=3)
+        self.assertEqual(self.ids(batches), [[1, 2, 3], [4, 5, 6], [7]])
+        self.assertEqual([(c['limit'], c.get('offset')) for c in
+                TestAdapter.calls], [(3, None), (3, 3), (3, 6)])
+
+    def test_keyset_condition_ignored(self):
+        """should raise when a keyset page repeats the previous one"""
+        self.Test.reader.read = lambda **kwargs: [{ 'id': i }
+                                                  for i in range(1, 4)]
+        batches = self.relation.find_in_batches(batch_size=3)
+        self.assertEqual(self.ids([batches.next()]), [[1, 2, 3]])
+        self.assertRaises(errors.BrokenAdapterStack, batches.next)
+
+    def test_offset_pagination(self):
+        """should page with limit and offset when a limit is given"""
+        batches = self.relation.offset(1).limit(5).find_in_batches(2)
+        self.assertEqual(self.ids(batches), [[2, 3], [4, 5], [6]])
+        self.assertEqual([(c['limit'], c['offset']) for c in
+                TestAdapter.calls], [(2, 1), (2, 3), (1, 5)])
+
+    def test_find_each(self):
+        """should yield each record with finder options applied"""
+        ids = [r.id for r in self.relation.find_each(2, where='id > 4')]
+        self.assertEqual(ids, [5, 6, 7])
+
+    def test_invalid_batch_size(self):
+        """should raise for batch sizes less than 1"""
+        self.assertRaises(errors.ArgumentError, list,
+                self.relation.find_in_batches(0))
+
+    def test_sql_literal(self):
+        """should format primary key values for conditions"""
+        self.assertEqual(self.relation._sql_literal(5L), '5')
+        self.assertEqual(self.relation._sql_literal("o'k"), "'o''k'")
+
+
+class StreamingAdapter(TestAdapter):
+    """Adapter yielding records lazily when asked to stream"""
+
+    def __init__(self, *args, **kwargs):
+        super(StreamingAdapter, self).__init__(*args, **kwargs)
+        self.features['streaming'] = True
+
+    def read(self, **kwargs):
+        self.calls.append(kwargs.get('stream'))
+        return ({ 'id': i } for i in range(3))
+
+
+class RelationStreamTestCase(BaseRelationTestCase):
+
+    def test_stream(self):
+        """should stream records from a streaming adapter stack"""
+        self.Test.reader = StreamingAdapter()
+        records = self.relation.stream(where='foo')
+        self.assertFalse(isinstance(records, list))
+        self.assertEqual([r.id for r in records], [0, 1, 2])
+        self.assertEqual(TestAdapter.calls, [True])
+
+    def test_stream_without_streaming_stack(self):
+        """should read the whole result when the stack can't stream"""
+        self.Test.reader = StreamingAdapter(
+                processors=[PreloadAssociations])
+        self.assertEqual([r.id for r in self.relation.stream()], [0, 1, 2])
+        self.assertEqual(TestAdapter.calls, [False])
+
+
+class CountingAdapter(TestAdapter):
+    """Adapter that can count records"""
+
+    def __init__(self, *args, **kwargs):
+        super(CountingAdapter, self).__init__(*args, **kwargs)
+        self.features['count'] = True
+
+    def count(self, **kwargs):
+        self.calls.append(('count', kwargs['relation'].query()))
+        return 42
+
+
+class RelationCountTestCase(BaseRelationTestCase):
+
+    def test_count_with_adapter(self):
+        """should ask adapters that support counting for the count"""
+        self.Test.reader = CountingAdapter()
+        self.assertEqual(self.relation.where('foo').count(), 42)
+        self.assertEqual(TestAdapter.calls, [('count', {'where': ['foo']})])
+
+    def test_count_fallback(self):
+        """should count the fetched records for other adapters"""
+        self.assertEqual(self.relation.count(where='foo'), 3)
+        self.assertEqual(TestAdapter.calls, [{'where': ['foo']}])
+
+    def test_count_loaded_records(self):
+        """should count records that are already loaded"""
+        self.Test.reader = CountingAdapter()
+        rel = self.relation.where('foo')
+        rel._records = [self.Test()]
+        self.assertEqual(rel.count(), 1)
+        self.assertEqual(TestAdapter.calls, [])
+
+    def test_exists(self):
+        """should fetch at most one record to check for existence"""
+        self.assertTrue(self.relation.exists(where='foo'))
+        self.assertEqual(TestAdapter.calls,
+                [{'where': ['foo'], 'limit': 1}])
+        TestAdapter.count = 0
+        self.assertFalse(self.relation.exists())
+
+
+class RelationPluckTestCase(BaseRelationTestCase):
+
+    def setUp(self):
+        super(RelationPluckTestCase, self).setUp()
+        self.Test.name = Field(name='full_name')
+        self.Test.age = Field(type=int)
+        TestAdapter.data = { 'id': 1, 'full_name': 'Ann', 'age': '24' }
+        TestAdapter.count = 2
+
+    def test_pluck(self):
+        """should return tuples of values selected from the adapter"""
+        values = self.relation.where('foo').pluck('id', 'name', 'age')
+        self.assertEqual(values, [(1, 'Ann', 24), (1, 'Ann', 24)])
+        self.assertEqual(self.last_call,
+                { 'where': ['foo'], 'select': ['id', 'full_name', 'age'] })
+
+    def test_pluck_single(self):
+        """should return a list of values for a single field"""
+        self.assertEqual(self.relation.pluck('id'), [1, 1])
+
+    def test_pluck_requires_fields(self):
+        """should raise if no fields are given"""
+        self.assertRaises(errors.ArgumentError, self.relation.pluck)
+
+    def test_skips_instantiation(self):
+        """should not instantiate models"""
+        def fail(*args, **kwargs):
+            raise AssertionError('model instantiated')
+        self.Test.__init__ = fail
+        self.assertEqual(self.relation.pluck('id'), [1, 1])
+
+    def test_values(self):
+        """should return dicts of the given fields"""
+        self.assertEqual(self.relation.values('name', 'age'),
+                [{ 'name': 'Ann', 'age': 24 }] * 2)
+        self.assertEqual(self.last_call, { 'select': ['full_name', 'age'] })
+
+    def test_values_all_fields(self):
+        """should include every defined field without a select"""
+        self.assertEqual(self.relation.values(),
+                [{ 'id': 1, 'name': 'Ann', 'age': 24 }] * 2)
+        self.assertEqual(self.last_call, {})
+
+
+class KeyAdapter(TestAdapter):
+    """Adapter returning a record for each primary key queried"""
+
+    def read(self, **kwargs):
+        query = kwargs['relation'].query()
+        self.calls.append(query)
+        return [{ 'id': key } for key in query['where'][0]['id']
+                if key != 'missing']
+
+
+class RelationChunkedFindTestCase(BaseRelationTestCase):
+
+    def setUp(self):
+        super(RelationChunkedFindTestCase, self).setUp()
+        self.Test.reader = KeyAdapter()
+        self.Test.find_chunk_size = 2
+
+    def test_chunks(self):
+        """should fetch long key lists in chunks in the requested order"""
+        records = self.relation.find([5, 3, 1, 4, 2])
+        self.assertEqual([r.id for r in records], [5, 3, 1, 4, 2])
+        self.assertEqual(sorted(call['where'] for call in TestAdapter.calls),
+                [[{'id': [1, 4]}], [{'id': [2]}], [{'id': [5, 3]}]])
+
+    def test_duplicate_keys(self):
+        """should send duplicate keys once"""
+        records = self.relation.find([1, 2, 1, 2])
+        self.assertEqual([r.id for r in records], [1, 2])
+        self.assertEqual(TestAdapter.calls, [{ 'where': [{'id': [1, 2]}] }])
+
+    def test_missing_keys(self):
+        """should raise if any chunk is missing records"""
+        self.assertRaises(errors.RecordNotFound, self.relation.find,
+                [1, 2, 'missing'])
+
+    def test_same_result(self):
+        """should return a relation in the requested order for any length"""
+        reader = self.Test.reader
+        reader.read = lambda **kwargs: list(reversed(KeyAdapter.read(
+                reader, **kwargs)))
+        small = self.relation.find([1, 2])
+        chunked = self.relation.find([1, 2, 3])
+        self.assertTrue(isinstance(small, Relation))
+        self.assertTrue(isinstance(chunked, Relation))
+        self.assertEqual([r.id for r in small], [1, 2])
+        self.assertEqual([r.id for r in chunked], [1, 2, 3])
+
+    def test_key_types(self):
+        """should count records found for keys of another type"""
+        reader = self.Test.reader
+        reader.read = lambda **kwargs: [{ 'id': int(record['id']) }
+                for record in KeyAdapter.read(reader, **kwargs)]
+        for keys in (['2', '1'], ['3', '2', '1']):
+            records = self.relation.find(keys)
+            self.assertEqual(sorted(r.id for r in records),
+                             sorted(int(key) for key in keys))
+
+    def test_fetch_in(self):
+        """should fetch the records for the keys of any attribute"""
+        records = self.relation.fetch_in('id', [1, 2, 3, 3])
+        self.assertEqual(sorted(r.id for r in records), [1, 2, 3])
+
+
 ##
 # First method
 #
@@ -785,10 +1207,42 @@ class RelationActsLikeListTestCase(BaseRelationTestCase):
         self.assertEqual(self.relation[0].id, 1)
 
     def test_splicing(self):
-        """Splices should work on the list of records"""
+        """Splices should work on the list of loaded records"""
+        self.relation.fetch_records()
         result = [ i.id for i in self.relation[0:2] ]
         self.assertEqual(result, [1, 1])
 
+    def test_slice_pushdown(self):
+        """should fetch unloaded slices with offset and limit"""
+        self.relation.where('foo')[100:120]
+        self.assertEqual(self.last_call,
+                { 'where': ['foo'], 'offset': 100, 'limit': 20 })
+        self.relation[5:]
+        self.assertEqual(self.last_call, { 'offset': 5 })
+        self.relation[:5]
+        self.assertEqual(self.last_call, { 'limit': 5 })
+
+    def test_slice_within_offset_and_limit(self):
+        """should slice within an existing offset and limit"""
+        self.relation.offset(10).limit(5)[2:20]
+        self.assertEqual(self.last_call, { 'offset': 12, 'limit': 3 })
+        self.assertEqual(self.relation.limit(5)[5:10], [])
+        self.assertEqual(len(TestAdapter.calls), 1)
+
+    def test_index_pushdown(self):
+        """should fetch an unloaded index with offset and limit 1"""
+        self.assertEqual(self.relation[3].id, 1)
+        self.assertEqual(self.last_call, { 'offset': 3, 'limit': 1 })
+        TestAdapter.count = 0
+        self.assertRaises(IndexError, self.relation.__getitem__, 3)
+
+    def test_negative_and_step_fallback(self):
+        """should fetch every record for negative indexes and steps"""
+        self.assertEqual(self.relation[-1].id, 1)
+        self.assertEqual(len(self.relation[::2]), 2)
+        self.assertEqual(len(self.relation[-2:]), 2)
+        self.assertEqual(TestAdapter.calls, [{}])
+
     def test_len(self):
         """len should return record count"""
         self.assertEqual(len(self.relation), 3)
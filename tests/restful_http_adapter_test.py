@@ -250,6 +250,42 @@ class ReadTestCase(HttpAdapterTestCase):
                           relation=pyperry.Base.scoped())
 
 
+class CountTestCase(HttpAdapterTestCase):
+
+    def setUp(self):
+        self.config = { 'host': 'localhost:8888', 'service': 'foo',
+                        'count_service': 'foo/count' }
+        self.adapter = RestfulHttpAdapter(self.config)
+
+    def test_feature(self):
+        """should support counting when a count_service is configured"""
+        self.assertTrue(self.adapter.features['count'])
+        del self.config['count_service']
+        adapter = RestfulHttpAdapter(self.config)
+        self.assertFalse(adapter.features['count'])
+
+    def test_request(self):
+        """should GET the count service with the relation's query"""
+        http_server.set_response(body=json.dumps(5))
+        relation = pyperry.Base.scoped().limit(1)
+        self.assertEqual(self.adapter.count(relation=relation), 5)
+        last_request = http_server.last_request()
+        self.assertEqual(last_request['method'], 'GET')
+        self.assertEqual(last_request['path'], '/foo/count.json?limit=1')
+
+    def test_count_dict(self):
+        """should read the count key of a dict response"""
+        http_server.set_response(body=json.dumps({'count': 7}))
+        self.assertEqual(self.adapter.count(relation=pyperry.Base.scoped()),
+                7)
+
+    def test_malformed(self):
+        """should raise if the response is not a count"""
+        http_server.set_response(body=json.dumps([]))
+        self.assertRaises(errors.MalformedResponse, self.adapter.count,
+                          relation=pyperry.Base.scoped())
+
+
 class PersistenceTestCase(HttpAdapterTestCase):
     """
     Because the create, update, and delete test cases are so similar, the tests